@@ -0,0 +1,86 @@
+import argparse
+import json
+import sys
+import time
+
+from corpsearch import searchers, batch_entries, is_valid_name
+import config
+
+
+def read_names(lines):
+    """Yields the company names in JSON Lines input, where each line is
+    either a JSON string or an object with a "name". Blank lines are
+    skipped, and lines that can't be decoded give None, which is reported
+    as an invalid name."""
+    for line in lines:
+        if not line.strip():
+            continue
+
+        try:
+            name = json.loads(line)
+        except ValueError:
+            yield None
+            continue
+
+        if isinstance(name, dict):
+            name = name.get('name')
+
+        yield name
+
+
+def chunks(names, size):
+    """Yields lists of at most `size` names from an iterable of names."""
+    chunk = []
+    for name in names:
+        chunk.append(name)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+
+def classify_batch(names, networks, deadline=None):
+    """Returns batch entries for a list of names on each of the networks,
+    as the /companies/batch endpoint does."""
+    valid_names = [x for x in names if is_valid_name(x)]
+    network_results = [searchers[network].query_many(valid_names, deadline)
+                       for network in networks]
+
+    return batch_entries(names, networks, network_results)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Classifies company names read as JSON Lines, writing '
+                    'a line of results for each name, in the same order.')
+    parser.add_argument('input', nargs='?', type=argparse.FileType('r'),
+                        default=sys.stdin,
+                        help='file to read names from (default: stdin)')
+    parser.add_argument('--output', type=argparse.FileType('w'),
+                        default=sys.stdout,
+                        help='file to write results to (default: stdout)')
+    parser.add_argument('--networks', nargs='+', choices=sorted(searchers),
+                        default=sorted(searchers))
+    parser.add_argument('--chunk-size', type=int,
+                        default=config.batch_max_names,
+                        help='number of names searched for and classified '
+                             'together')
+    parser.add_argument('--deadline', type=float,
+                        help='seconds each chunk may spend retrieving posts')
+    args = parser.parse_args()
+
+    for chunk in chunks(read_names(args.input), args.chunk_size):
+        deadline = None
+        if args.deadline is not None:
+            deadline = time.time() + args.deadline
+
+        for entry in classify_batch(chunk, args.networks, deadline):
+            args.output.write(json.dumps(entry) + '\n')
+
+        args.output.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -13,3 +13,110 @@ converter = Final
 tokenizer = LowerTokenizer
 
 evaluate_converter = Final
+
+# Size of the thread pool that runs searches and classification off the
+# IOLoop, so that slow upstream calls don't block other requests.
+executor_workers = 8
+
+# In-memory cache of classification results, per network. Entries expire
+# after result_cache_ttl seconds; the policy is either 'lru' or 'fifo'.
+result_cache_size = 1000
+result_cache_ttl = 60*60
+result_cache_policy = 'lru'
+
+# Server options. With server_processes other than 1, the server loads the
+# models and then forks that many workers (0 means one per CPU), replacing
+# workers that crash up to server_max_restarts times; graceful restarts
+# (SIGHUP) aren't counted. A single process ignores SIGHUP, as nothing would
+# restart it. Workers being shut down wait up to shutdown_timeout seconds for
+# in-flight requests to finish.
+server_port = 2020
+server_processes = 1
+server_max_restarts = 100
+shutdown_timeout = 30
+
+# How often, in seconds, the classifier files are checked for changes and
+# reloaded. None disables the check; models can still be reloaded with
+# SIGUSR1 or a POST to /admin/reload from the local machine. With several
+# worker processes, the parent process reloads the models and then restarts
+# the workers one at a time, so that they keep sharing one copy; a POST to
+# /admin/reload only reloads the worker that handles it.
+model_watch_interval = 30
+
+# Default number of seconds a search may spend retrieving posts before
+# profiles are classified with the data available so far. Requests can
+# override this with a `deadline` argument. None means no deadline.
+default_deadline = 20
+
+# Admission control, per network: at most admission_max_concurrent searches
+# run at once, and up to admission_max_queue more wait for up to
+# admission_queue_timeout seconds. Other requests get a 503 response with a
+# Retry-After of admission_retry_after seconds.
+admission_max_concurrent = 4
+admission_max_queue = 16
+admission_queue_timeout = 10
+admission_retry_after = 5
+
+# Batch requests may give at most batch_max_names names, which are searched
+# for concurrently by up to batch_search_workers threads, shared by all
+# batches. Longer lists can be classified with batch.py, which reads names
+# as JSON Lines and works through them batch_max_names at a time.
+batch_max_names = 50
+batch_search_workers = 8
+
+# Number of threads fetching posts for a query's profiles concurrently,
+# shared by all queries. Keep this low enough to respect rate limits.
+posts_fetch_workers = 8
+
+# Connections kept alive per host by the shared HTTP session, the default
+# (connect, read) timeout in seconds for its requests, and how many times
+# failed connections are retried.
+http_pool_size = 20
+http_timeout = (5, 30)
+http_retries = 1
+
+# Twitter credentials to spread calls across, as (access token, access token
+# secret) pairs; more credentials give more calls per rate limit window.
+# Low priority calls, such as cache warming, leave the last
+# twitter_rate_limit_reserve calls of each window for searches.
+twitter_credentials = []
+twitter_rate_limit_reserve = 50
+
+# Cached API results are refreshed in the background by this many threads.
+# Every cache_refresh_interval seconds (None disables this), each cache's
+# cache_refresh_keys most read keys since the last check are refreshed if
+# they expire within cache_refresh_ahead seconds.
+cache_refresh_workers = 4
+cache_refresh_interval = 60*10
+cache_refresh_keys = 100
+cache_refresh_ahead = 60*60*24
+
+# Caches whose recently used entries are also kept in each process's
+# memory, in front of MongoDB: at most max_size entries, each for at most
+# ttl seconds, so that changes made by other processes are seen within that.
+memory_caches = {
+    'twitter_search': {'max_size': 1000, 'ttl': 60*10},
+    'twitter_profiles': {'max_size': 5000, 'ttl': 60*10},
+    'twitter_posts': {'max_size': 5000, 'ttl': 60*10},
+    'facebook_search': {'max_size': 1000, 'ttl': 60*10},
+    'facebook_profiles': {'max_size': 5000, 'ttl': 60*10},
+    'facebook_posts': {'max_size': 5000, 'ttl': 60*10},
+    'ddg': {'max_size': 1000, 'ttl': 60*10}
+}
+
+# Where cached results are stored: 'mongo', 'sqlite' (a file in the cache
+# directory, needing no server), 'memory' (not kept between runs, or shared
+# between processes), or 'shelve' (not safe for several processes to write
+# at once). cache_backend is used by expiring caches (API results), and
+# file_cache_backend by caches whose results never expire (resolved URLs).
+# See simplediskcache.benchmark to compare them.
+cache_backend = 'mongo'
+file_cache_backend = 'sqlite'
+
+# Caches created before keys were hashed look for results under their old,
+# unhashed keys on a miss, moving any they find to the new key. Each cache
+# records when it started doing so; expiring caches stop once their old
+# entries have all expired, and caches whose results never expire (resolved
+# URLs) after this many seconds, after which resolved URLs that haven't been
+# migrated are resolved again.
+legacy_cache_keys_period = 60*60*24*90
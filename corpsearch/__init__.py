@@ -1,26 +1,172 @@
-from tornado.web import RequestHandler, Application
+from concurrent.futures import ThreadPoolExecutor
+from math import ceil
+from time import time
+import json
 
-from searcher import TwitterSearcher, FacebookSearcher
+from tornado import gen
+from tornado.ioloop import IOLoop
+from tornado.iostream import StreamClosedError
+from tornado.log import app_log
+from tornado.queues import Queue
+from tornado.escape import json_decode
+from tornado.web import RequestHandler, Application, HTTPError
+
+from companyscorer.searchengines.ratelimit import RateLimited
+from searcher import TwitterSearcher, FacebookSearcher, normalize_query
+from admission import AdmissionController, Overloaded, Slots
 from duckduckdescription import DuckDuckDescription
+import config
+import metrics
 
 
 twitter_searcher = TwitterSearcher()
 facebook_searcher = FacebookSearcher()
+searchers = {
+    'twitter': twitter_searcher,
+    'facebook': facebook_searcher
+}
 
+# Limits on the searches in progress at once for each network.
+admission = {
+    network: AdmissionController(
+        name=network,
+        max_concurrent=config.admission_max_concurrent,
+        max_queue=config.admission_max_queue,
+        queue_timeout=config.admission_queue_timeout,
+        retry_after=config.admission_retry_after)
+    for network in searchers
+}
+
+# Searching and classifying is blocking (network calls, feature extraction,
+# and prediction), so it's run on this pool rather than on the IOLoop.
+executor = ThreadPoolExecutor(config.executor_workers)
+
+
+def reload_models(only_changed=False):
+    """Reloads each network's classifier and preprocessed data, or only
+    those of networks whose classifier files have changed. Returns a
+    dictionary of the new model versions keyed by network."""
+    versions = {}
+    for network, searcher in searchers.iteritems():
+        if only_changed and not searcher.model_changed():
+            continue
+
+        versions[network] = searcher.reload()
+        app_log.info('Reloaded %s model (version %s).', network,
+                     versions[network])
+
+    return versions
+
+
+@gen.coroutine
+def admit(networks):
+    """Waits for an admission slot on each of the networks, returning a
+    context manager that releases them. Slots are always taken in sorted
+    order, so that requests for several networks can't each hold slots
+    that another is waiting for.
+
+        with (yield admit(['twitter', 'facebook'])):
+            ...
+    """
+    slots = []
+    try:
+        for network in sorted(networks):
+            slot = yield admission[network].acquire()
+            slots.append(slot)
+    except Exception:
+        Slots(slots).release()
+        raise
+
+    raise gen.Return(Slots(slots))
+
+
+def preload():
+    """Loads the preprocessed feature data for every network, so that it's
+    in memory before the first query."""
+    twitter_searcher.preload()
+    facebook_searcher.preload()
+
+
+class BaseHandler(RequestHandler):
+    """Base RequestHandler for all endpoints. Keeps count of the requests
+    currently being handled, so that a server can wait for them to finish
+    before shutting down."""
+    active_requests = 0
 
-class DuckDuckGoDescriptionHandler(RequestHandler):
-    """RequestHandler for /company/<name>/description."""
     def set_default_headers(self):
         self.set_header("Access-Control-Allow-Origin", "*")
 
+    def prepare(self):
+        self.counted_as_active = True
+        BaseHandler.active_requests += 1
+
+    def on_finish(self):
+        self.release_active()
+        metrics.request_latency.observe(self.request.request_time(),
+                                        handler=type(self).__name__,
+                                        status=self.get_status())
+
+    def on_connection_close(self):
+        self.release_active()
+
+    def send_error(self, status_code=500, **kwargs):
+        # Running out of API calls is a temporary condition, like being
+        # overloaded, rather than an internal error.
+        if 'exc_info' in kwargs and isinstance(kwargs['exc_info'][1],
+                                               RateLimited):
+            status_code = 503
+
+        super(BaseHandler, self).send_error(status_code, **kwargs)
+
+    def write_error(self, status_code, **kwargs):
+        if 'exc_info' in kwargs and isinstance(kwargs['exc_info'][1],
+                                               (Overloaded, RateLimited)):
+            self.set_header('Retry-After',
+                            int(ceil(kwargs['exc_info'][1].retry_after)))
+
+        super(BaseHandler, self).write_error(status_code, **kwargs)
+
+    def log_exception(self, typ, value, tb):
+        if isinstance(value, RateLimited):
+            app_log.warning('%s: %s', self._request_summary(), value)
+        else:
+            super(BaseHandler, self).log_exception(typ, value, tb)
+
+    def get_deadline(self):
+        """Returns the time by which a search should finish, taken from the
+        `deadline` query argument (in seconds from now), or from
+        config.default_deadline. Returns None if there's no deadline."""
+        seconds = self.get_argument('deadline', None)
+        if seconds is None:
+            seconds = config.default_deadline
+            if seconds is None:
+                return None
+
+        try:
+            return time() + float(seconds)
+        except ValueError:
+            raise HTTPError(400, 'The deadline must be a number of seconds.')
+
+    def release_active(self):
+        """Stops counting this request as active. Requests that failed
+        before prepare() was called were never counted."""
+        if getattr(self, 'counted_as_active', False):
+            self.counted_as_active = False
+            BaseHandler.active_requests -= 1
+
+
+class DuckDuckGoDescriptionHandler(BaseHandler):
+    """RequestHandler for /company/<name>/description."""
+    @gen.coroutine
     def get(self, name):
         """Handles GET requests, taking in a company's name and
         returning a description for that company from DuckDuckGo."""
         if not name:
             self.write({})
             self.finish()
+            return
 
-        ddg_result = DuckDuckDescription.query(name)
+        ddg_result = yield executor.submit(DuckDuckDescription.query, name)
         if ddg_result:
             self.write({
                 'name': ddg_result['name'],
@@ -33,11 +179,9 @@ class DuckDuckGoDescriptionHandler(RequestHandler):
         self.finish()
 
 
-class TwitterResultHandler(RequestHandler):
+class TwitterResultHandler(BaseHandler):
     """RequestHandler for /company/<name>/twitter."""
-    def set_default_headers(self):
-        self.set_header("Access-Control-Allow-Origin", "*")
-
+    @gen.coroutine
     def get(self, name):
         """Handles GET requests, taking in a company's name and
         returning a dictionary of classified profiles on Twitter
@@ -47,64 +191,339 @@ class TwitterResultHandler(RequestHandler):
             self.finish()
             return
 
-        results = twitter_searcher.query(name)
+        # Time spent waiting for admission counts against the deadline.
+        deadline = self.get_deadline()
+        with (yield admission['twitter'].acquire()):
+            results = yield executor.submit(twitter_searcher.query, name,
+                                            deadline)
 
         self.write(create_results_dict(results))
         self.finish()
 
 
-class FacebookResultHandler(RequestHandler):
+class FacebookResultHandler(BaseHandler):
     """RequestHandler for /company/<name>/facebook."""
-    def set_default_headers(self):
-        self.set_header("Access-Control-Allow-Origin", "*")
-
+    @gen.coroutine
     def get(self, name):
         """Handles GET requests, taking in a company's name and
         returning a dictionary of classified profiles on Facebook
         for the company."""
         if not name:
             self.write({})
-            self.finish
+            self.finish()
             return
 
-        results = facebook_searcher.query(name)
+        # Time spent waiting for admission counts against the deadline.
+        deadline = self.get_deadline()
+        with (yield admission['facebook'].acquire()):
+            results = yield executor.submit(facebook_searcher.query, name,
+                                            deadline)
 
         self.write(create_results_dict(results))
         self.finish()
 
+
+class AllResultsHandler(BaseHandler):
+    """RequestHandler for /company/<name>/all."""
+    @gen.coroutine
+    def get(self, name):
+        """Handles GET requests, taking in a company's name and
+        returning its DuckDuckGo description along with classified profiles
+        on Twitter and Facebook. The networks are searched concurrently,
+        sharing cached and in-progress results with the single network
+        endpoints. The DuckDuckGo lookup is shared with the ones the
+        classifiers make, while it's in progress, and through its cache
+        afterwards."""
+        if not name:
+            self.write({})
+            self.finish()
+            return
+
+        deadline = self.get_deadline()
+        with (yield admit(['twitter', 'facebook'])):
+            ddg_result, twitter_results, facebook_results = yield [
+                executor.submit(DuckDuckDescription.query, name.lower()),
+                executor.submit(twitter_searcher.query, name, deadline),
+                executor.submit(facebook_searcher.query, name, deadline)
+            ]
+
+        description = {}
+        if ddg_result:
+            description = {
+                'name': ddg_result['name'],
+                'description': ddg_result['description']
+            }
+
+        self.write({
+            'description': description,
+            'twitter': create_results_dict(twitter_results),
+            'facebook': create_results_dict(facebook_results)
+        })
+        self.finish()
+
+
+class StreamingResultHandler(BaseHandler):
+    """RequestHandler for /company/<name>/<network>/stream. Results are sent
+    as server-sent events: a 'profile' event for each profile as soon as
+    it's classified, followed by a 'summary' event with the same results
+    the non-streaming endpoint returns. Results that are cached, or being
+    searched for by an identical request, are sent all at once; see
+    SingleNetworkSearcher.stream."""
+    def initialize(self, network):
+        self.network = network
+        self.searcher = searchers[network]
+
+    @gen.coroutine
+    def get(self, name):
+        """Handles GET requests, taking in a company's name and streaming
+        classified profiles for the company on this handler's network."""
+        # Time spent waiting for admission counts against the deadline.
+        deadline = self.get_deadline()
+        with (yield admission[self.network].acquire()):
+            yield self.stream(name, deadline)
+
+    @gen.coroutine
+    def stream(self, name, deadline=None):
+        """Writes the events for a company's name, searching for it until
+        `deadline`."""
+        self.set_header('Content-Type', 'text/event-stream')
+        self.set_header('Cache-Control', 'no-cache')
+
+        if not name:
+            self.write_event('summary', {})
+            self.finish()
+            return
+
+        # Results are produced on the executor and handed back to the IOLoop
+        # through this queue, with None marking the end of the stream.
+        queue = Queue()
+        io_loop = IOLoop.current()
+
+        def produce():
+            try:
+                for item in self.searcher.stream(name, deadline):
+                    io_loop.add_callback(queue.put, item)
+            except Exception as e:
+                io_loop.add_callback(queue.put, ('error', str(e)))
+            finally:
+                io_loop.add_callback(queue.put, None)
+
+        executor.submit(produce)
+        features = self.searcher.feature_labels()
+
+        while True:
+            item = yield queue.get()
+            if item is None:
+                break
+
+            event, payload = item
+            if event == 'summary':
+                self.write_event('summary', create_results_dict(payload))
+            elif event == 'error':
+                self.write_event('error', {'message': payload})
+            else:
+                result = create_result_entry(payload, features)
+                result['category'] = result_categories[event]
+                self.write_event('profile', result)
+
+            try:
+                yield self.flush()
+            except StreamClosedError:
+                return
+
+        self.finish()
+
+    def write_event(self, event, data):
+        """Writes a single server-sent event with a JSON payload."""
+        self.write('event: %s\ndata: %s\n\n' % (event, json.dumps(data)))
+
+
+class BatchResultHandler(BaseHandler):
+    """RequestHandler for /companies/batch."""
+    @gen.coroutine
+    def post(self):
+        """Handles POST requests, taking in a JSON body of the form
+        {"names": [...], "networks": [...]}, and returning classified profiles
+        for each name on each network. "networks" is optional, and defaults
+        to both Twitter and Facebook. At most config.batch_max_names names
+        can be given, and they're searched for under the request's
+        deadline, as for a single name; larger lists can be classified with
+        batch.py instead.
+
+        Results are returned in the same order as the names; see
+        `batch_entries`."""
+        try:
+            body = json_decode(self.request.body)
+            names = body['names']
+            networks = body.get('networks', sorted(searchers.keys()))
+        except (ValueError, KeyError, TypeError, AttributeError):
+            raise HTTPError(400, 'Expected a JSON body with a list of names.')
+
+        if not isinstance(names, list) or not isinstance(networks, list):
+            raise HTTPError(400, 'Expected a JSON body with a list of names.')
+
+        if len(names) > config.batch_max_names:
+            raise HTTPError(400, 'At most %d names can be given.' %
+                            config.batch_max_names)
+
+        if any(x not in searchers for x in networks):
+            raise HTTPError(400, 'Unknown network.')
+
+        if len(set(networks)) != len(networks):
+            raise HTTPError(400, 'Networks may only be given once.')
+
+        valid_names = [x for x in names if is_valid_name(x)]
+        deadline = self.get_deadline()
+        with (yield admit(networks)):
+            network_results = yield [
+                executor.submit(searchers[network].query_many, valid_names,
+                                deadline)
+                for network in networks
+            ]
+
+        self.write({'results': batch_entries(names, networks,
+                                             network_results)})
+        self.finish()
+
+
+class ReloadHandler(BaseHandler):
+    """RequestHandler for /admin/reload."""
+    @gen.coroutine
+    def post(self):
+        """Handles POST requests from the local machine, reloading every
+        network's classifier and preprocessed data. Returns the new model
+        versions."""
+        if self.request.remote_ip not in ('127.0.0.1', '::1'):
+            raise HTTPError(403)
+
+        versions = yield executor.submit(reload_models)
+        self.write(versions)
+        self.finish()
+
+
+class MetricsHandler(BaseHandler):
+    """RequestHandler for /metrics."""
+    def get(self):
+        """Handles GET requests, returning the server's metrics in the
+        Prometheus text format."""
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.write(metrics.render())
+        self.finish()
+
+
 app = Application([
     (r'/company/(.*)/description', DuckDuckGoDescriptionHandler),
     (r'/company/(.*)/twitter', TwitterResultHandler),
-    (r'/company/(.*)/facebook', FacebookResultHandler)
+    (r'/company/(.*)/facebook', FacebookResultHandler),
+    (r'/company/(.*)/all', AllResultsHandler),
+    (r'/company/(.*)/twitter/stream', StreamingResultHandler,
+     dict(network='twitter')),
+    (r'/company/(.*)/facebook/stream', StreamingResultHandler,
+     dict(network='facebook')),
+    (r'/companies/batch', BatchResultHandler),
+    (r'/metrics', MetricsHandler),
+    (r'/admin/reload', ReloadHandler)
 ])
 
+# Maps classifier categories to the names used by the front-end.
+result_categories = {
+    'official': 'belonging',
+    'affiliate': 'affiliate',
+    'unrelated': 'notBelonging'
+}
+
+
+def is_valid_name(name):
+    """Returns whether a company name given in a request can be searched
+    for."""
+    return isinstance(name, basestring) and bool(name.strip())
+
+
+def batch_entries(names, networks, network_results):
+    """Returns an entry for each of the names in a batch, in the same order,
+    given the results of query_many for each network. Entries that aren't
+    valid names (non-empty strings) hold an error message instead of
+    results, as do entries for a name whose search failed on a network, in
+    place of that network's results."""
+    entries = []
+    for name in names:
+        if not is_valid_name(name):
+            entries.append({
+                'name': name,
+                'error': 'Names must be non-empty strings.'
+            })
+            continue
+
+        key = normalize_query(name)
+        entry = {'name': name}
+
+        for network, searched in zip(networks, network_results):
+            result = searched[key]
+            if isinstance(result, Exception):
+                entry[network] = {'error': str(result)}
+            else:
+                entry[network] = create_results_dict(result)
+
+        entries.append(entry)
+
+    return entries
+
 
 def create_results_dict(results):
     """Helper method to convert a set of results into a front-end-friendly
     form."""
-    official = [{
-            'profile': result['profile'].to_dict(),
-            'probability': result['probability'],
-            'vector': result['vector'],
-            'vectorLabels': results.features
-        } for result in results.official]
-
-    affiliate = [{
-        'profile': result['profile'].to_dict(),
-        'probability': result['probability'],
-        'vector': result['vector'],
-        'vectorLabels': results.features
-    } for result in results.affiliate]
+    official = [create_result_entry(result, results.features)
+                for result in results.official]
+
+    affiliate = [create_result_entry(result, results.features)
+                 for result in results.affiliate]
 
-    unrelated = [{
-            'profile': result['profile'].to_dict(),
-            'probability': result['probability'],
-            'vector': result['vector'],
-            'vectorLabels': results.features
-    } for result in results.unrelated]
+    unrelated = [create_result_entry(result, results.features)
+                 for result in results.unrelated]
 
     return {
         'belonging': official,
         'affiliate': affiliate,
-        'notBelonging': unrelated
+        'notBelonging': unrelated,
+        'partial': results.partial
+    }
+
+
+def create_result_entry(result, features):
+    """Helper method to convert a single classified profile into a
+    front-end-friendly form."""
+    return {
+        'profile': result['profile'].to_dict(),
+        'probability': result['probability'],
+        'vector': result['vector'],
+        'vectorLabels': features,
+        'partial': result['profile'].partial
     }
+
+
+def preprocessed_data_metric(key):
+    """Returns a function giving the value of `key` in the preprocessed
+    data stats for each network, for use with Gauge.set_function."""
+    def values():
+        stats = config.converter.preprocessed_data_stats()
+        return {(network,): x[key] for network, x in stats.iteritems()}
+
+    return values
+
+
+metrics.preprocessed_data_load_seconds.set_function(
+    preprocessed_data_metric('load_seconds'))
+metrics.preprocessed_data_bytes.set_function(
+    preprocessed_data_metric('bytes'))
+metrics.result_cache_entries.set_function(lambda: {
+    (network,): len(searcher.result_cache)
+    for network, searcher in searchers.iteritems()
+})
+metrics.admission_running.set_function(lambda: {
+    (network,): controller.running
+    for network, controller in admission.iteritems()
+})
+metrics.admission_waiting.set_function(lambda: {
+    (network,): controller.waiting
+    for network, controller in admission.iteritems()
+})
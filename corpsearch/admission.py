@@ -0,0 +1,104 @@
+from datetime import timedelta
+
+from tornado import gen
+from tornado.locks import Semaphore
+from tornado.web import HTTPError
+
+import metrics
+
+
+class Overloaded(HTTPError):
+    """Raised when a request can't be admitted. Results in a 503 response
+    asking the client to retry after `retry_after` seconds."""
+    def __init__(self, retry_after):
+        super(Overloaded, self).__init__(503, 'Too many requests in progress.')
+        self.retry_after = retry_after
+
+
+class AdmissionController(object):
+    """Limits the number of pipeline executions in progress at once. Up to
+    `max_queue` requests beyond `max_concurrent` wait for a slot, for at most
+    `queue_timeout` seconds; any more are rejected straight away.
+
+    This is only used from the IOLoop thread, so it isn't thread-safe."""
+    def __init__(self, name, max_concurrent, max_queue, queue_timeout=None,
+                 retry_after=1):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+
+        self.semaphore = Semaphore(max_concurrent)
+        self.running = 0
+        self.waiting = 0
+
+    @gen.coroutine
+    def acquire(self):
+        """Waits for a slot, returning a context manager that releases it.
+        Raises Overloaded if the queue is full, or the wait times out.
+
+            with (yield controller.acquire()):
+                ...
+        """
+        if self.running + self.waiting >= self.max_concurrent + self.max_queue:
+            self.reject()
+
+        timeout = None
+        if self.queue_timeout is not None:
+            timeout = timedelta(seconds=self.queue_timeout)
+
+        self.waiting += 1
+        try:
+            yield self.semaphore.acquire(timeout)
+        except gen.TimeoutError:
+            self.reject()
+        finally:
+            self.waiting -= 1
+
+        self.running += 1
+        raise gen.Return(Slot(self))
+
+    def release(self):
+        """Releases a slot taken with `acquire`."""
+        self.running -= 1
+        self.semaphore.release()
+
+    def reject(self):
+        """Counts a rejected request, and raises Overloaded."""
+        metrics.admission_rejected.inc(network=self.name)
+        raise Overloaded(self.retry_after)
+
+
+class Slot(object):
+    """Context manager for a slot taken from an AdmissionController."""
+    def __init__(self, controller):
+        self.controller = controller
+
+    def release(self):
+        """Gives the slot back to the controller."""
+        self.controller.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+class Slots(object):
+    """Context manager for slots taken from several AdmissionControllers,
+    releasing them all."""
+    def __init__(self, slots):
+        self.slots = slots
+
+    def release(self):
+        """Gives each slot back to its controller."""
+        for slot in self.slots:
+            slot.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
@@ -1,75 +1,157 @@
 from itertools import izip
 from collections import namedtuple
 
+import metrics
+
 ClassificationResult = namedtuple('ClassificationResult',
                                   ['company_name',
                                    'official',
                                    'unrelated',
                                    'affiliate',
-                                   'features'])
+                                   'features',
+                                   'partial'])
 
 
 class NetworkClassifier(object):
     """Classifies profiles for a given network as belonging to a particular
     company or not."""
-    def __init__(self, classifier, profile_converter, network):
+    def __init__(self, classifier, profile_converter, network,
+                 preprocessed_data=None):
         self.classifier = classifier
         self.profile_converter = profile_converter
         self.network = network
+        self.preprocessed_data = preprocessed_data
 
     def classify_profiles(self, name, profiles):
         """Given the name of a company and an enumerable of profiles,
         returns a classification result for that enumerable."""
-
-        feature_list = self.profile_converter.feature_vector_labels()
         if not len(profiles):
-            return ClassificationResult(company_name=name,
-                                        official=[],
-                                        affiliate=[],
-                                        unrelated=[],
-                                        features=feature_list)
-
-        official = []
-        affiliate = []
-        unrelated = []
-
-        preprocessed_data = self.profile_converter.retrieve_preprocessed_data(
-            self.network)
+            return self.build_result(name, official=[], affiliate=[],
+                                     unrelated=[])
+
+        categorized = {
+            'official': [],
+            'affiliate': [],
+            'unrelated': []
+        }
+
+        preprocessed_data = self.feature_data()
         feature_vectors = [self.profile_converter.convert_to_feature_vector(
                             name, x, data=preprocessed_data)
                            for x in profiles]
 
-        predicted_probabilities = self.classifier.predict_proba(feature_vectors)
-        predicted_classes = self.classifier.predict(feature_vectors)
+        with metrics.stage_latency.time(stage='predict'):
+            predicted_probabilities = self.classifier.predict_proba(
+                feature_vectors)
+            predicted_classes = self.classifier.predict(feature_vectors)
 
         for prediction in izip(predicted_probabilities,
                                profiles,
                                feature_vectors,
                                predicted_classes):
-            profile_predicted_official = prediction[3] == 2
-            profile_predicted_affiliate = prediction[3] == 1
-            profile = prediction[1]
-            vector = prediction[2]
-
-            if profile_predicted_official:
-                official.append({
-                    'profile': profile,
-                    'probability': prediction[0][2],
-                    'vector': vector
-                })
-            elif profile_predicted_affiliate:
-                affiliate.append({
-                    'profile': profile,
-                    'probability': prediction[0][1],
-                    'vector': vector
-                })
-            else:
-                unrelated.append({
-                    'profile': profile,
-                    'probability': prediction[0][0],
-                    'vector': vector
-                })
+            category, entry = categorize(*prediction)
+            categorized[category].append(entry)
+
+        return self.build_result(name, **categorized)
+
+    def classify_many(self, named_profiles):
+        """Given a list of (company name, profiles) pairs, returns a list
+        with a classification result for each pair. The preprocessed data is
+        retrieved once, and all feature vectors are classified together.
+
+        If converting a pair's profiles to feature vectors fails, the
+        exception is returned in place of that pair's result."""
+        preprocessed_data = self.feature_data()
+
+        results = []
+        all_vectors = []
+        for name, profiles in named_profiles:
+            try:
+                vectors = [self.profile_converter.convert_to_feature_vector(
+                            name, x, data=preprocessed_data)
+                           for x in profiles]
+            except Exception as e:
+                results.append(e)
+                continue
+
+            results.append(vectors)
+            all_vectors.extend(vectors)
+
+        if len(all_vectors):
+            with metrics.stage_latency.time(stage='predict'):
+                predicted_probabilities = self.classifier.predict_proba(
+                    all_vectors)
+                predicted_classes = self.classifier.predict(all_vectors)
+        else:
+            predicted_probabilities = []
+            predicted_classes = []
+
+        offset = 0
+        for idx, (name, profiles) in enumerate(named_profiles):
+            vectors = results[idx]
+            if isinstance(vectors, Exception):
+                continue
+
+            categorized = {
+                'official': [],
+                'affiliate': [],
+                'unrelated': []
+            }
+
+            end = offset + len(vectors)
+            for prediction in izip(predicted_probabilities[offset:end],
+                                   profiles,
+                                   vectors,
+                                   predicted_classes[offset:end]):
+                category, entry = categorize(*prediction)
+                categorized[category].append(entry)
 
+            offset = end
+            results[idx] = self.build_result(name, **categorized)
+
+        return results
+
+    def iter_classify_profiles(self, name, profiles):
+        """Like `classify_profiles`, but classifies each profile as soon as
+        the `profiles` iterable produces it, yielding a (category, entry)
+        pair where category is 'official', 'affiliate', or 'unrelated'.
+
+        The last pair yielded is ('summary', result), where result is the
+        ClassificationResult for all of the profiles."""
+        categorized = {
+            'official': [],
+            'affiliate': [],
+            'unrelated': []
+        }
+
+        preprocessed_data = self.feature_data()
+        for profile in profiles:
+            vector = self.profile_converter.convert_to_feature_vector(
+                name, profile, data=preprocessed_data)
+
+            with metrics.stage_latency.time(stage='predict'):
+                probabilities = self.classifier.predict_proba([vector])[0]
+                predicted_class = self.classifier.predict([vector])[0]
+
+            category, entry = categorize(probabilities, profile, vector,
+                                         predicted_class)
+            categorized[category].append(entry)
+            yield category, entry
+
+        yield 'summary', self.build_result(name, **categorized)
+
+    def feature_data(self):
+        """Returns the preprocessed data for this network. If this
+        classifier was given preprocessed data when created, that's used
+        instead of the profile converter's."""
+        if self.preprocessed_data is not None:
+            return self.preprocessed_data
+
+        return self.profile_converter.retrieve_preprocessed_data(self.network)
+
+    def build_result(self, name, official, affiliate, unrelated):
+        """Given lists of categorized entries, returns a sorted
+        ClassificationResult."""
         # We sort belonging in descending order of probability, but not-belonging
         # in ascending order. This is because profiles which we're not entirely
         # sure don't belong are more interesting than the ones that definitely don't.
@@ -79,10 +161,37 @@ class NetworkClassifier(object):
                            key=lambda x: x['probability'])
         unrelated = sorted(unrelated, key=lambda x: x['probability'])
 
+        partial = any(x['profile'].partial
+                      for x in official + affiliate + unrelated)
+
         result = ClassificationResult(
             company_name=name,
             official=official,
             unrelated=unrelated,
             affiliate=affiliate,
-            features=feature_list)
+            features=self.profile_converter.feature_vector_labels(),
+            partial=partial)
         return result
+
+
+def categorize(probabilities, profile, vector, predicted_class):
+    """Given the predicted probabilities and class for a profile and its
+    feature vector, returns a (category, entry) pair for it."""
+    if predicted_class == 2:
+        return 'official', {
+            'profile': profile,
+            'probability': probabilities[2],
+            'vector': vector
+        }
+    elif predicted_class == 1:
+        return 'affiliate', {
+            'profile': profile,
+            'probability': probabilities[1],
+            'vector': vector
+        }
+
+    return 'unrelated', {
+        'profile': profile,
+        'probability': probabilities[0],
+        'vector': vector
+    }
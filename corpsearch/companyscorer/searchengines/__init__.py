@@ -1,2 +1,3 @@
 from facebooksearch import FacebookSearch
 from twittersearch import TwitterSearch
+from replaysearch import ReplaySearch
@@ -1,29 +1,70 @@
+import json
+import urllib
+
 import facebook
+import requests
 
 from trainer.social_profile import FacebookProfile
 from trainer.social_post import FacebookPost
-from simplediskcache.SimpleDiskCache import expiring_cache
+from simplediskcache.SimpleDiskCache import expiring_cache, EXPIRED
+from simplediskcache.keys import normalized
+from postfetcher import PostFetches, executor, finished_by, merge_posts
+from graphclient import get_graph
+import metrics
 
 # TODO: obtain from user.
 access_token = "" # Removed.
 
+# The maximum number of requests the Graph API accepts in one batch.
+MAX_BATCH_SIZE = 50
+
+# The number of posts the Graph API returns for a page, and the most kept
+# for a page when its posts are refreshed.
+POSTS_PAGE_SIZE = 25
+
 
 class FacebookSearch(object):
     """Handles searching on Facebook."""
 
     @staticmethod
-    def query(query):
+    def query(query, deadline=None):
         """Given a query, returns Facebook pages
-        corresponding to that query."""
+        corresponding to that query. See `iter_query` for `deadline`."""
+        return list(FacebookSearch.iter_query(query, deadline))
+
+    @staticmethod
+    def iter_query(query, deadline=None):
+        """Given a query, yields Facebook pages corresponding to that
+        query as soon as each one's posts have been retrieved. Posts are
+        fetched for all of the pages concurrently.
+
+        `deadline` is an optional time (as returned by time.time()) after
+        which posts are no longer waited for. Pages whose posts weren't
+        retrieved by then have no posts, and are marked as partial. If the
+        batch request for posts is still running then, pages only have
+        posts that were already cached, and it carries on in the
+        background to cache the rest."""
         profiles = search_facebook(query)
+        profile_ids = [x['id'] for x in profiles]
 
-        processed = []
-        for profile in profiles:
-            profile_id = profile['id']
-            posts = posts_for(profile_id)
-            processed.append(FacebookProfile(profile, posts))
+        prefetch = executor.submit(prefetch_posts, profile_ids)
+        if not finished_by(prefetch, deadline):
+            cached = posts_for.lookup_stale_many([(x,) for x in profile_ids])
+            for profile, (found, posts, state) in zip(profiles, cached):
+                usable = found and state != EXPIRED
+                processed = FacebookProfile(profile, posts if usable else [])
+                processed.partial = not usable
+                yield processed
 
-        return processed
+            return
+
+        with PostFetches(posts_for, profile_ids) as fetches:
+            for profile in profiles:
+                posts, partial = fetches.wait(profile['id'], deadline)
+
+                processed = FacebookProfile(profile, posts)
+                processed.partial = partial
+                yield processed
 
     @staticmethod
     def posts_for(profile_id):
@@ -32,35 +73,203 @@ class FacebookSearch(object):
         return [FacebookPost(x) for x in posts]
 
 
-@expiring_cache('facebook', 60*60*24*100)
+@metrics.timed('search_facebook')
 def search_facebook(query, access_token=access_token):
     """Given a query and access token, searches Facebook for pages
-    matching that query. Uses an expiring_cache."""
-    graph = facebook.GraphAPI(access_token=access_token)
-    skeleton_graph_results = graph.request('/search', {
-                                           'access_token': access_token,
-                                           'q': query.encode('utf-8'),
-                                           'type': 'page'
-                                           })['data']
+    matching that query. Pages are cached once each, shared between the
+    queries that find them, while each query only caches the IDs it
+    found."""
+    graph_ids = search_facebook_ids(query, access_token)
+    return cached_profiles(graph_ids, access_token)
+
+
+@expiring_cache('facebook_search', 60*60*24*100, grace=60*60*24*7,
+                key_func=normalized('query'))
+def search_facebook_ids(query, access_token=access_token):
+    """Given a query and access token, searches Facebook for pages
+    matching that query, and returns their IDs. Pages whose cached profiles
+    have expired are retrieved again. Uses an expiring_cache."""
+    graph = get_graph(access_token)
+    try:
+        skeleton_graph_results = graph.request('/search', {
+                                               'access_token': access_token,
+                                               'q': query.encode('utf-8'),
+                                               'type': 'page'
+                                               })['data']
+    except facebook.GraphAPIError:
+        metrics.upstream_errors.inc(service='facebook')
+        raise
 
     graph_ids = [x['id'] for x in skeleton_graph_results][:20]
-    if len(graph_ids):
-        profiles = graph.get_objects(graph_ids).values()
-    else:
-        profiles = []
+    cached = facebook_profile.lookup_many([(x,) for x in graph_ids])
+    retrieve_profiles([x for x, (found, _) in zip(graph_ids, cached)
+                       if not found], access_token)
+
+    return graph_ids
+
+
+@expiring_cache('facebook_profiles', 60*60*24*100)
+def facebook_profile(profile_id, access_token=access_token):
+    """Given a page ID and access token, returns that page's profile.
+    Uses an expiring_cache, which searches also store the profiles they
+    find in."""
+    graph = get_graph(access_token)
+    try:
+        return graph.request(str(profile_id), {'access_token': access_token})
+    except facebook.GraphAPIError:
+        metrics.upstream_errors.inc(service='facebook')
+        raise
+
+
+def cached_profiles(profile_ids, access_token=access_token):
+    """Given a list of page IDs, returns their profiles in the same
+    order. Profiles are taken from the cache even if they've expired, as
+    they were cached when a search returning them last ran; only those
+    that aren't cached at all are retrieved."""
+    cached = facebook_profile.lookup_stale_many([(x,) for x in profile_ids])
+    profiles = {}
+    for profile_id, (found, profile, _) in zip(profile_ids, cached):
+        if found:
+            profiles[profile_id] = profile
+
+    profiles.update(retrieve_profiles(
+        [x for x in profile_ids if x not in profiles], access_token))
+
+    return [profiles[x] for x in profile_ids if x in profiles]
+
+
+def retrieve_profiles(profile_ids, access_token=access_token):
+    """Retrieves the profiles of the given pages in one request, caches
+    them, and returns them keyed by ID."""
+    if not len(profile_ids):
+        return {}
+
+    graph = get_graph(access_token)
+    try:
+        profiles = graph.get_objects(profile_ids)
+    except facebook.GraphAPIError:
+        metrics.upstream_errors.inc(service='facebook')
+        raise
+
+    for profile_id, profile in profiles.iteritems():
+        facebook_profile.store(profile, profile_id)
 
     return profiles
 
 
-@expiring_cache('facebook_posts', 60*60*24*100)
+def refresh_posts(posts, profile_id, access_token=access_token):
+    """Given the expired cached posts for a profile, retrieves only the
+    posts made since the newest of them, and merges them in."""
+    new_posts = page_posts(profile_id, access_token, since_newest(posts))
+    return merge_posts(new_posts, posts, POSTS_PAGE_SIZE)
+
+
+@metrics.timed('facebook_posts')
+@expiring_cache('facebook_posts', 60*60*24*100, refresh=refresh_posts,
+                grace=60*60*24*7, legacy_keys=True)
 def posts_for(profile_id, access_token=access_token):
     """Given a profile ID and access token, returns posts by that
-    profile. Uses an expiring_cache."""
-    graph = facebook.GraphAPI(access_token=access_token)
-    posts = graph.request('/v2.3/' + str(profile_id) + "/posts", {
-                            'access_token': access_token,
-                          })['data']
+    profile. Uses an expiring_cache, refreshed with refresh_posts."""
+    return page_posts(profile_id, access_token)
+
+
+def page_posts(profile_id, access_token, args=None):
+    """Returns the latest posts by a profile, taking the Graph API
+    arguments (such as since) given."""
+    request_args = dict(args or {})
+    request_args['access_token'] = access_token
+
+    graph = get_graph(access_token)
+    try:
+        posts = graph.request(posts_path(profile_id), request_args)['data']
+    except facebook.GraphAPIError:
+        metrics.upstream_errors.inc(service='facebook')
+        raise
+
+    return filter_posts(posts)
+
+
+def posts_path(profile_id):
+    """Returns the Graph API path for a profile's posts."""
+    return 'v2.3/' + str(profile_id) + '/posts'
+
+
+def since_newest(posts):
+    """Returns the Graph API arguments to retrieve only posts made since
+    the newest of the given posts."""
+    times = [x['created_time'] for x in posts if 'created_time' in x]
+    if not len(times):
+        return {}
+
+    # Times are ISO 8601 strings in the same time zone, so they sort
+    # chronologically.
+    return {'since': max(times)}
+
+
+@metrics.timed('facebook_posts_batch')
+def prefetch_posts(profile_ids, access_token=access_token):
+    """Given a list of page IDs and an access token, retrieves posts for
+    every page whose posts aren't already cached using Graph API batch
+    requests, and stores them in posts_for's cache. Pages whose cached
+    posts have expired only have newer posts retrieved, as in
+    refresh_posts; stale posts are left for posts_for to refresh in the
+    background. Pages that fail in the batch, or all of them if the batch
+    request itself fails, are left for posts_for to retrieve
+    individually."""
+    cached = posts_for.lookup_stale_many([(x,) for x in profile_ids])
+    missing = []
+    stale_posts = {}
+    for profile_id, (found, posts, state) in zip(profile_ids, cached):
+        if not found or state == EXPIRED:
+            missing.append(profile_id)
+            stale_posts[profile_id] = posts if found else []
+
+    if not len(missing):
+        return
+
+    graph = get_graph(access_token)
+    for start in range(0, len(missing), MAX_BATCH_SIZE):
+        chunk = missing[start:start + MAX_BATCH_SIZE]
+        batch = [{
+            'method': 'GET',
+            'relative_url': batch_url(profile_id, stale_posts[profile_id])
+        } for profile_id in chunk]
+
+        try:
+            responses = graph.request('', post_args={
+                                      'access_token': access_token,
+                                      'batch': json.dumps(batch)
+                                      })
+        except (facebook.GraphAPIError, requests.RequestException):
+            metrics.upstream_errors.inc(service='facebook')
+            return
+
+        for profile_id, response in zip(chunk, responses):
+            # Requests in a batch can fail, or time out (giving null),
+            # independently of each other.
+            if not response or response.get('code') != 200:
+                metrics.upstream_errors.inc(service='facebook')
+                continue
+
+            posts = json.loads(response['body']).get('data', [])
+            posts_for.store(merge_posts(filter_posts(posts),
+                                        stale_posts[profile_id],
+                                        POSTS_PAGE_SIZE), profile_id)
+
+
+def batch_url(profile_id, stale_posts):
+    """Returns the relative URL for a batch request for a profile's posts,
+    retrieving only posts newer than its expired cached posts."""
+    since = since_newest(stale_posts)
+    if not len(since):
+        return posts_path(profile_id)
+
+    return posts_path(profile_id) + '?' + urllib.urlencode(since)
+
 
+def filter_posts(posts):
+    """Given posts returned by the Graph API, returns those with content
+    that can be used in classification."""
     if len(posts):
         return [x for x in posts if 'message' in x or 'description' in x]
 
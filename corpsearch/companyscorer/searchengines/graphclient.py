@@ -0,0 +1,68 @@
+import threading
+
+import facebook
+
+import httpclient
+
+GRAPH_URL = 'https://graph.facebook.com/'
+
+
+class GraphClient(object):
+    """Makes Facebook Graph API requests over the shared, pooled HTTP
+    session. Supports the parts of facebook.GraphAPI used here, and raises
+    facebook.GraphAPIError in the same way."""
+    def __init__(self, access_token=None):
+        self.access_token = access_token
+
+    def request(self, path, args=None, post_args=None):
+        """Makes a request to the given Graph API path, with `args` in the
+        query string and, for POST requests, `post_args` in the body.
+        Returns the decoded response."""
+        args = dict(args or {})
+        if post_args is not None:
+            post_args = dict(post_args)
+
+        if self.access_token:
+            target = post_args if post_args is not None else args
+            target.setdefault('access_token', self.access_token)
+
+        url = GRAPH_URL + path.lstrip('/')
+        if post_args is not None:
+            response = httpclient.post(url, params=args, data=post_args)
+        else:
+            response = httpclient.get(url, params=args)
+
+        try:
+            result = response.json()
+        except ValueError:
+            raise facebook.GraphAPIError({
+                'error': {
+                    'type': 'InvalidResponse',
+                    'message': 'Graph API returned a response that '
+                               'isn\'t JSON.'
+                }
+            })
+
+        if isinstance(result, dict) and 'error' in result:
+            raise facebook.GraphAPIError(result)
+
+        return result
+
+    def get_objects(self, ids, **args):
+        """Returns a dictionary of the objects with the given IDs, keyed
+        by ID."""
+        args['ids'] = ','.join(str(x) for x in ids)
+        return self.request('', args)
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_graph(access_token):
+    """Returns the shared GraphClient for an access token."""
+    with _clients_lock:
+        if access_token not in _clients:
+            _clients[access_token] = GraphClient(access_token)
+
+        return _clients[access_token]
@@ -0,0 +1,75 @@
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from itertools import chain
+from time import time
+
+import config
+
+# Posts for a query's profiles are fetched on this pool. Its size bounds
+# the number of requests made to each network at once.
+executor = ThreadPoolExecutor(config.posts_fetch_workers)
+
+
+class PostFetches(object):
+    """Fetches posts for a list of profiles concurrently, while letting
+    them be consumed in the original order.
+
+        with PostFetches(posts_for, profile_ids) as fetches:
+            for profile_id in profile_ids:
+                posts, partial = fetches.wait(profile_id, deadline)
+
+    Fetches that haven't started when the block is left are cancelled."""
+    def __init__(self, fetch, profile_ids):
+        self.futures = {}
+        for profile_id in profile_ids:
+            if profile_id not in self.futures:
+                self.futures[profile_id] = executor.submit(fetch, profile_id)
+
+    def wait(self, profile_id, deadline=None):
+        """Returns a (posts, partial) pair for the given profile, waiting
+        until `deadline` at most. If the posts aren't ready by then, they're
+        returned as an empty list, and partial is True. Exceptions raised
+        by the fetch are raised here."""
+        future = self.futures[profile_id]
+        if deadline is None:
+            return future.result(), False
+
+        try:
+            return future.result(timeout=max(0, deadline - time())), False
+        except TimeoutError:
+            future.cancel()
+            return [], True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for future in self.futures.itervalues():
+            future.cancel()
+
+
+def finished_by(future, deadline=None):
+    """Waits for a future until `deadline` at most, and returns whether it
+    finished. Exceptions raised by it are raised here. A future that hasn't
+    finished is left running."""
+    if deadline is None:
+        future.result()
+        return True
+
+    try:
+        future.result(timeout=max(0, deadline - time()))
+        return True
+    except TimeoutError:
+        return False
+
+
+def merge_posts(new_posts, cached_posts, limit):
+    """Merges newly retrieved posts into a cached timeline, both newest
+    first, leaving out duplicates and keeping the newest `limit` posts."""
+    merged = []
+    seen = set()
+    for post in chain(new_posts, cached_posts):
+        if post['id'] not in seen:
+            seen.add(post['id'])
+            merged.append(post)
+
+    return merged[:limit]
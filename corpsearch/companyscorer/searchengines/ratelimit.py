@@ -0,0 +1,140 @@
+from contextlib import contextmanager
+from time import time
+import threading
+
+from simplediskcache.SimpleDiskCache import in_background_refresh
+import metrics
+
+# Length of a rate limit window, used when a response doesn't say when the
+# window resets.
+DEFAULT_WINDOW = 15 * 60
+
+
+class RateLimited(Exception):
+    """Raised when a call can't be made without exceeding the rate limit
+    of every credential. `retry_after` is the number of seconds until the
+    earliest window resets."""
+    def __init__(self, endpoint, retry_after):
+        super(RateLimited, self).__init__(
+            'Rate limit reached for %s; retry in %d seconds.' %
+            (endpoint, retry_after))
+        self.endpoint = endpoint
+        self.retry_after = retry_after
+
+
+_priority = threading.local()
+
+
+@contextmanager
+def low_priority():
+    """Marks calls made by this thread within the block as low priority,
+    such as cache warming. Low priority calls leave each window's reserve
+    for interactive searches. Background cache refreshes are always low
+    priority.
+
+        with low_priority():
+            posts_for(profile_id)
+    """
+    previous = getattr(_priority, 'low', False)
+    _priority.low = True
+    try:
+        yield
+    finally:
+        _priority.low = previous
+
+
+def is_low_priority():
+    """Returns whether calls made by this thread are low priority."""
+    return getattr(_priority, 'low', False) or in_background_refresh()
+
+
+class RateLimiter(object):
+    """Spreads calls to an API's endpoints across a pool of credentials,
+    tracking how many calls each credential has left in the current window
+    from the API's response headers.
+
+    Rather than waiting for a window to reset, acquire() raises RateLimited
+    when no credential has calls left, and low priority calls are refused
+    once only `reserve` calls are left."""
+    def __init__(self, name, credentials, reserve=0):
+        if not credentials:
+            raise ValueError('At least one credential is needed.')
+
+        self.name = name
+        self.credentials = list(credentials)
+        self.reserve = reserve
+
+        # (remaining, reset) pairs keyed by (credential, endpoint).
+        self.windows = {}
+        self.next_index = 0
+        self.lock = threading.Lock()
+
+    def acquire(self, endpoint):
+        """Returns the credential to make a call to `endpoint` with: the one
+        with the most calls left, preferring those whose limits aren't known
+        yet. Counts the call against it until update() is called."""
+        reserve = self.reserve if is_low_priority() else 0
+        now = time()
+
+        with self.lock:
+            chosen, chosen_remaining, earliest_reset = None, None, None
+
+            # Starting from a different credential each time spreads calls
+            # evenly while their limits are unknown.
+            count = len(self.credentials)
+            for offset in xrange(count):
+                credential = self.credentials[(self.next_index + offset) %
+                                              count]
+                remaining = self.remaining(credential, endpoint, now)
+                if remaining is None:
+                    chosen, chosen_remaining = credential, None
+                    break
+
+                if remaining <= reserve:
+                    reset = self.windows[(credential, endpoint)][1]
+                    if earliest_reset is None or reset < earliest_reset:
+                        earliest_reset = reset
+                elif chosen is None or remaining > chosen_remaining:
+                    chosen, chosen_remaining = credential, remaining
+
+            self.next_index = (self.next_index + 1) % count
+
+            if chosen is None:
+                metrics.rate_limited.inc(service=self.name)
+                raise RateLimited(endpoint, max(0, earliest_reset - now))
+
+            if chosen_remaining is not None:
+                reset = self.windows[(chosen, endpoint)][1]
+                self.windows[(chosen, endpoint)] = (chosen_remaining - 1,
+                                                    reset)
+
+            return chosen
+
+    def remaining(self, credential, endpoint, now=None):
+        """Returns the number of calls `credential` has left for `endpoint`
+        in the current window, or None if that isn't known."""
+        window = self.windows.get((credential, endpoint))
+        if window is None or window[1] <= (now or time()):
+            return None
+
+        return window[0]
+
+    def update(self, credential, endpoint, headers):
+        """Records the limits given in a response's headers."""
+        remaining = headers.get('x-rate-limit-remaining')
+        reset = headers.get('x-rate-limit-reset')
+        if remaining is None or reset is None:
+            return
+
+        with self.lock:
+            self.windows[(credential, endpoint)] = (int(remaining),
+                                                    float(reset))
+
+    def exhausted(self, credential, endpoint, reset=None):
+        """Records that `credential` has no calls left for `endpoint` until
+        `reset`, or until the end of a default window if that isn't known."""
+        if reset is None:
+            reset = time() + DEFAULT_WINDOW
+
+        with self.lock:
+            self.windows[(credential, endpoint)] = (0, float(reset))
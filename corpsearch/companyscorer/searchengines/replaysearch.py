@@ -0,0 +1,139 @@
+import json
+
+from simplediskcache.keys import normalize_text
+from trainer.social_profile import TwitterProfile, FacebookProfile
+from trainer.social_post import TwitterPost, FacebookPost
+
+profile_types = {
+    'twitter': TwitterProfile,
+    'facebook': FacebookProfile
+}
+
+post_types = {
+    'twitter': TwitterPost,
+    'facebook': FacebookPost
+}
+
+
+class ReplaySearch(object):
+    """Serves searches from stored search results rather than the live
+    APIs, so that evaluations and load tests are fast, repeatable, and
+    don't need network access. Can be used in place of TwitterSearch or
+    FacebookSearch.
+
+    Results are loaded either from the labelled search results in MongoDB
+    (see `from_mongo`), or from a snapshot file exported from them (see
+    `from_file` and `export`). A query returns the profiles labelled for
+    it, in the order they were stored; unknown queries return nothing."""
+    def __init__(self, network, results):
+        """`results` is a dictionary of lists keyed by query, each entry
+        being a dictionary with the `profile`, its `posts`, and its
+        `label`."""
+        self.network = network
+        self.profile_type = profile_types[network]
+        self.post_type = post_types[network]
+
+        self.results = results
+
+        self.index = {}
+        self.posts = {}
+        for query, entries in results.iteritems():
+            self.index.setdefault(replay_key(query), []).extend(entries)
+            for entry in entries:
+                self.posts[entry['profile']['id']] = entry['posts']
+
+    @classmethod
+    def from_mongo(cls, network, client=None):
+        """Loads the labelled search results for a network from MongoDB,
+        from the collections the trainer uses."""
+        if client is None:
+            import mongo
+            client = mongo.client
+
+        labels = client.labels[network]
+        profiles = client.searchresults[network + 'Profiles']
+        posts = client.posts[network]
+
+        records = list(labels.find())
+        profile_ids = list(set(x['profile'] for x in records))
+
+        stored_profiles = {}
+        for profile in profiles.find({'_id': {'$in': profile_ids}}):
+            stored_profiles[profile.pop('_id')] = profile
+
+        user_ids = [x['id'] for x in stored_profiles.itervalues()]
+        stored_posts = {}
+        for post in posts.find({'user': {'$in': user_ids}}):
+            stored_posts.setdefault(post['user'], []).append(post['post'])
+
+        results = {}
+        for record in records:
+            profile = stored_profiles.get(record['profile'])
+            if profile is None:
+                continue
+
+            if profile.get('protected'):
+                profile_posts = []
+            else:
+                profile_posts = stored_posts.get(profile['id'], [])
+
+            results.setdefault(record['query'], []).append({
+                'profile': profile,
+                'posts': profile_posts,
+                'label': record['label']
+            })
+
+        return cls(network, results)
+
+    @classmethod
+    def from_file(cls, filename):
+        """Loads search results from a snapshot file written by `export`."""
+        with open(filename) as snapshot_file:
+            snapshot = json.load(snapshot_file)
+
+        return cls(snapshot['network'], snapshot['results'])
+
+    def export(self, filename):
+        """Writes these search results to a snapshot file, which can be
+        loaded with `from_file` without access to MongoDB."""
+        snapshot = {
+            'network': self.network,
+            'results': self.results
+        }
+
+        with open(filename, 'w') as snapshot_file:
+            json.dump(snapshot, snapshot_file)
+
+    def entries(self):
+        """Returns the stored results as labelled entries, in the same form
+        as trainer.get_twitter_entries and trainer.get_facebook_entries.
+        Entries are sorted by query, so that evaluations are repeatable."""
+        return [{
+            'name': query,
+            'profile': entry['profile'],
+            'posts': entry['posts'],
+            'label': entry['label']
+        } for query, entries in sorted(self.results.iteritems())
+          for entry in entries]
+
+    def query(self, query, deadline=None):
+        """Given a query, returns the stored profiles for that query.
+        `deadline` is accepted for compatibility, as nothing is waited
+        for."""
+        return list(self.iter_query(query, deadline))
+
+    def iter_query(self, query, deadline=None):
+        """Given a query, yields the stored profiles for that query."""
+        for entry in self.index.get(replay_key(query), []):
+            yield self.profile_type(entry['profile'], entry['posts'])
+
+    def posts_for(self, profile_id):
+        """Given a profile ID, returns the stored posts by that profile."""
+        return [self.post_type(x) for x in self.posts.get(profile_id, [])]
+
+
+def replay_key(query):
+    """Returns the key results for a query are stored under, ignoring case
+    and extra whitespace, as the search engines' caches do."""
+    return normalize_text(query)
+
@@ -0,0 +1,55 @@
+from time import time
+
+import pytest
+import requests
+
+from .. import facebooksearch
+from ..facebooksearch import FacebookSearch
+from simplediskcache import SimpleDiskCache
+from simplediskcache.backends import MemoryBackend
+
+
+@pytest.fixture(autouse=True)
+def memory_backend(monkeypatch):
+    """Stores cached results in a MemoryBackend, without a memory tier in
+    front of it. Each test gets its own backends."""
+    backends = {}
+    monkeypatch.setattr(SimpleDiskCache, 'configured_backend',
+                        lambda setting, name, lifetime=None:
+                        backends.setdefault(name, MemoryBackend(name)))
+    monkeypatch.setattr(SimpleDiskCache, 'memory_cache_for',
+                        lambda filename: None)
+
+
+class TimingOutBatches(object):
+    """Graph API client whose batch requests time out, while requests for
+    a single page's posts succeed."""
+    def request(self, path, args=None, post_args=None):
+        if post_args is not None:
+            raise requests.ReadTimeout('Timed out.')
+
+        return {'data': [{
+            'id': path,
+            'message': 'Posted by ' + path,
+            'created_time': '2015-06-01T12:00:00+0000'
+        }]}
+
+
+@pytest.mark.parametrize('deadline', [None, 60])
+def test_failed_batch_falls_back_to_single_pages(monkeypatch, deadline):
+    """Tests that posts are retrieved for each page individually if the
+    batch request for them fails."""
+    monkeypatch.setattr(facebooksearch, 'get_graph',
+                        lambda access_token: TimingOutBatches())
+    monkeypatch.setattr(facebooksearch, 'search_facebook',
+                        lambda query: [{'id': '1', 'name': 'Apple'},
+                                       {'id': '2', 'name': 'Apple Inc.'}])
+
+    if deadline is not None:
+        deadline += time()
+
+    profiles = FacebookSearch.query('apple', deadline)
+
+    assert [x.handle for x in profiles] == ['1', '2']
+    assert [len(x.posts) for x in profiles] == [1, 1]
+    assert not any(x.partial for x in profiles)
@@ -0,0 +1,75 @@
+from time import time
+
+import pytest
+
+from ..ratelimit import RateLimiter, RateLimited, low_priority
+
+
+def limits(remaining, reset_in=60):
+    """Returns response headers giving the calls left in a window."""
+    return {
+        'x-rate-limit-remaining': str(remaining),
+        'x-rate-limit-reset': str(time() + reset_in)
+    }
+
+
+def test_credentials_rotated_while_limits_unknown():
+    """Tests that calls are spread across credentials whose limits aren't
+    known yet."""
+    limiter = RateLimiter('test', ['a', 'b', 'c'])
+    assert [limiter.acquire('search') for _ in range(3)] == ['a', 'b', 'c']
+
+
+def test_credential_with_most_calls_left_used():
+    """Tests that the credential with the most calls left is used, and
+    that the call is counted against it."""
+    limiter = RateLimiter('test', ['a', 'b'])
+    limiter.update('a', 'search', limits(2))
+    limiter.update('b', 'search', limits(5))
+
+    assert limiter.acquire('search') == 'b'
+    assert limiter.remaining('b', 'search') == 4
+    assert limiter.remaining('a', 'search') == 2
+
+
+def test_exhausted_credentials_skipped():
+    """Tests that exhausted credentials aren't used, and that RateLimited
+    is raised once none have calls left."""
+    limiter = RateLimiter('test', ['a', 'b'])
+    limiter.exhausted('a', 'search', time() + 30)
+    limiter.update('b', 'search', limits(1, reset_in=90))
+
+    assert limiter.acquire('search') == 'b'
+    with pytest.raises(RateLimited) as e:
+        limiter.acquire('search')
+
+    assert 0 < e.value.retry_after <= 30
+
+    # Limits are per endpoint.
+    assert limiter.acquire('timeline') in ['a', 'b']
+
+
+def test_window_reset():
+    """Tests that a credential can be used again once its window has
+    reset."""
+    limiter = RateLimiter('test', ['a'])
+    limiter.update('a', 'search', limits(0, reset_in=-1))
+
+    assert limiter.remaining('a', 'search') is None
+    assert limiter.acquire('search') == 'a'
+
+
+def test_low_priority_reserve():
+    """Tests that low priority calls leave the reserve for other calls."""
+    limiter = RateLimiter('test', ['a'], reserve=2)
+    limiter.update('a', 'search', limits(3))
+
+    with low_priority():
+        assert limiter.acquire('search') == 'a'
+        with pytest.raises(RateLimited):
+            limiter.acquire('search')
+
+    assert limiter.acquire('search') == 'a'
+    assert limiter.acquire('search') == 'a'
+    with pytest.raises(RateLimited):
+        limiter.acquire('search')
@@ -0,0 +1,119 @@
+import json
+import socket
+import sys
+
+import pytest
+
+from ..replaysearch import ReplaySearch
+from duckduckdescription import DuckDuckDescription
+from system.corpsearchsystem import CorpSearchSystem
+from system.modules.description.cosinesimilarity import\
+    CosineSimilarityDescriptionAndDDG
+from trainer.social_profile import TwitterProfile
+import evaluator
+
+
+class SerialPool(object):
+    """Stands in for pathos' ProcessingPool, running queries in this
+    process."""
+    def __init__(self, workers):
+        pass
+
+    def map(self, func, items):
+        return map(func, items)
+
+
+def twitter_entry(profile_id, description, label):
+    """Returns a labelled snapshot entry for a Twitter profile."""
+    return {
+        'profile': {
+            'id': profile_id,
+            'screen_name': 'profile%d' % profile_id,
+            'name': 'Profile %d' % profile_id,
+            'description': description,
+            'followers_count': 10,
+            'protected': False
+        },
+        'posts': [{
+            'text': description,
+            'id_str': str(profile_id),
+            'created_at': 'Mon Sep 24 03:35:21 +0000 2012'
+        }],
+        'label': label
+    }
+
+
+@pytest.fixture
+def snapshot(tmpdir):
+    """Writes a Twitter snapshot of 12 companies to a directory, each with
+    an official, an affiliate, and an unrelated profile, along with the
+    companies' DuckDuckGo descriptions."""
+    results = {}
+    descriptions = {}
+    for company in range(12):
+        query = 'Company %d' % company
+        about = 'company %d makes widgets and gadgets' % company
+        results[query] = [
+            twitter_entry(company * 3, about, 2),
+            twitter_entry(company * 3 + 1, 'news about ' + about, 1),
+            twitter_entry(company * 3 + 2, 'photos of my cat', 0)
+        ]
+        descriptions[query] = {
+            'name': query,
+            'description': {'text': about, 'source': 'Test', 'link': ''}
+        }
+
+    directory = str(tmpdir)
+    ReplaySearch('twitter', results).export(
+        evaluator.snapshot_file(directory, 'twitter'))
+    with open(evaluator.descriptions_file(directory), 'w') as snapshot_file:
+        json.dump(descriptions, snapshot_file)
+
+    return directory
+
+
+@pytest.fixture
+def offline(monkeypatch):
+    """Blocks MongoDB and network access, returning the list of attempts to
+    connect to anything."""
+    attempts = []
+
+    def blocked(*args, **kwargs):
+        attempts.append(args)
+        raise socket.error('Network access is blocked.')
+
+    monkeypatch.setattr(socket, 'socket', blocked)
+    monkeypatch.setattr(socket, 'create_connection', blocked)
+    monkeypatch.setitem(sys.modules, 'mongo', None)
+    monkeypatch.setattr(DuckDuckDescription, 'replayed', None)
+    monkeypatch.setattr(evaluator, 'ProcessingPool', SerialPool)
+    return attempts
+
+
+def test_replayed_query():
+    """Tests that queries return the stored profiles, ignoring case and
+    extra whitespace."""
+    search = ReplaySearch('twitter', {
+        'Apple': [twitter_entry(1, 'apples', 2)]
+    })
+
+    profiles = search.query(' apple ')
+    assert [x.handle for x in profiles] == ['profile1']
+    assert [x.content for x in search.posts_for(1)] == ['apples']
+    assert search.query('Banana') == []
+
+
+def test_snapshot_evaluation_offline(snapshot, offline):
+    """Tests that a snapshot can be evaluated, DuckDuckGo descriptions
+    included, without MongoDB or the network."""
+    entries, search_engine = evaluator.load_network('twitter', snapshot)
+    assert len(entries) == 36
+    assert DuckDuckDescription.query(' company 3')['name'] == 'Company 3'
+    assert DuckDuckDescription.query('Unknown') is None
+
+    converter = CorpSearchSystem('DDG', [CosineSimilarityDescriptionAndDDG])
+    results = evaluator.Evaluator(entries, TwitterProfile, search_engine,
+                                  'twitter', converter=converter).evaluate()
+
+    assert len(results['Random Forest']) == 10
+    assert offline == []
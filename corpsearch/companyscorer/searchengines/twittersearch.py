@@ -1,8 +1,15 @@
+import threading
+
 import tweepy
 
 from trainer.social_profile import TwitterProfile
 from trainer.social_post import TwitterPost
 from simplediskcache.SimpleDiskCache import expiring_cache
+from simplediskcache.keys import normalized
+from postfetcher import PostFetches, merge_posts
+from ratelimit import RateLimiter, RateLimited
+import config
+import metrics
 
 # TODO: move into config file.
 key = '' # Removed.
@@ -12,24 +19,53 @@ secret = '' # Removed.
 access_token = '' # Removed.
 access_token_secret = '' # Removed.
 
+# The number of posts a profile's timeline is fetched with, and the most
+# kept for it when it's refreshed.
+TIMELINE_SIZE = 20
+
+# Calls are spread across the configured credentials, falling back to the
+# token above if there are none.
+limiter = RateLimiter('twitter',
+                      config.twitter_credentials or
+                      [(access_token, access_token_secret)],
+                      reserve=config.twitter_rate_limit_reserve)
+
 
 class TwitterSearch(object):
     """Handles searching on Twitter."""
 
     @staticmethod
-    def query(query):
+    def query(query, deadline=None):
         """Given a query, returns Twitter profiles
-        corresponding to that query."""
+        corresponding to that query. See `iter_query` for `deadline`."""
+        return list(TwitterSearch.iter_query(query, deadline))
+
+    @staticmethod
+    def iter_query(query, deadline=None):
+        """Given a query, yields Twitter profiles corresponding to that
+        query as soon as each one's posts have been retrieved. Posts are
+        fetched for all of the profiles concurrently.
+
+        `deadline` is an optional time (as returned by time.time()) after
+        which posts are no longer waited for. Profiles whose posts weren't
+        retrieved by then, or couldn't be because of rate limits, have no
+        posts, and are marked as partial. Raises RateLimited if the search
+        itself can't be made."""
         profiles = search_twitter(query)
+        unprotected = [x['id'] for x in profiles if not x['protected']]
 
-        processed = []
-        for profile in profiles:
-            profile_id = profile['id']
-            posts = (posts_for(profile_id)
-                     if not profile['protected'] else [])
-            processed.append(TwitterProfile(profile, posts))
+        with PostFetches(posts_for, unprotected) as fetches:
+            for profile in profiles:
+                posts, partial = [], False
+                if not profile['protected']:
+                    try:
+                        posts, partial = fetches.wait(profile['id'], deadline)
+                    except RateLimited:
+                        posts, partial = [], True
 
-        return processed
+                processed = TwitterProfile(profile, posts)
+                processed.partial = partial
+                yield processed
 
     @staticmethod
     def posts_for(profile_id):
@@ -38,40 +74,153 @@ class TwitterSearch(object):
         return [TwitterPost(x) for x in posts]
 
 
-@expiring_cache('twitter', 60*60*24*100)
-def search_twitter(query,
-                   access_token=access_token,
-                   access_token_secret=access_token_secret):
-    """Given a query, access token, and access token secret,
-    searches Twitter for pages matching that query. Uses an expiring cache."""
-    api = get_api(access_token, access_token_secret)
+@metrics.timed('search_twitter')
+def search_twitter(query):
+    """Given a query, searches Twitter for pages matching that query.
+    Profiles are cached once each, shared between the queries that find
+    them, while each query only caches the IDs it found."""
+    return cached_profiles(search_twitter_ids(query))
 
-    return [x._json for x in api.search_users(query)]
 
+@expiring_cache('twitter_search', 60*60*24*100, grace=60*60*24*7,
+                key_func=normalized('query'))
+def search_twitter_ids(query):
+    """Given a query, searches Twitter for pages matching that query,
+    caches the profiles found, and returns their IDs. Uses an expiring
+    cache."""
+    try:
+        profiles = [x._json for x in call_api('users/search', 'search_users',
+                                              query)]
+    except tweepy.error.TweepError:
+        metrics.upstream_errors.inc(service='twitter')
+        raise
 
-@expiring_cache('twitter_posts', 60*60*24*100)
-def posts_for(profile_id,
-              access_token=access_token,
-              access_token_secret=access_token_secret):
-    """Gets the latest 20 posts for the user with the given ID.
-    Uses an expiring cache."""
-    api = get_api()
+    for profile in profiles:
+        twitter_profile.store(profile, profile['id'])
+
+    return [x['id'] for x in profiles]
+
+
+@expiring_cache('twitter_profiles', 60*60*24*100)
+def twitter_profile(profile_id):
+    """Given a Twitter profile ID, returns that profile. Uses an expiring
+    cache, which searches also store the profiles they find in."""
+    try:
+        return call_api('users/show', 'get_user', user_id=profile_id)._json
+    except tweepy.error.TweepError:
+        metrics.upstream_errors.inc(service='twitter')
+        raise
+
+
+def cached_profiles(profile_ids):
+    """Given a list of Twitter profile IDs, returns those profiles in the
+    same order. Profiles are taken from the cache even if they've expired,
+    as they were cached when a search returning them last ran; only those
+    that aren't cached at all are retrieved."""
+    cached = twitter_profile.lookup_stale_many([(x,) for x in profile_ids])
+    profiles = {}
+    for profile_id, (found, profile, _) in zip(profile_ids, cached):
+        if found:
+            profiles[profile_id] = profile
+
+    missing = [x for x in profile_ids if x not in profiles]
+    if len(missing):
+        try:
+            retrieved = call_api('users/lookup', 'lookup_users',
+                                 user_ids=missing)
+        except tweepy.error.TweepError:
+            metrics.upstream_errors.inc(service='twitter')
+            raise
+
+        for profile in (x._json for x in retrieved):
+            twitter_profile.store(profile, profile['id'])
+            profiles[profile['id']] = profile
+
+    # Profiles that no longer exist aren't returned by users/lookup.
+    return [profiles[x] for x in profile_ids if x in profiles]
+
+
+def refresh_posts(posts, profile_id):
+    """Given the expired cached posts for the user with the given ID,
+    retrieves only the posts made since the newest of them, and merges
+    them in. Keeps the cached posts if the new ones can't be retrieved."""
+    since = {}
+    if len(posts):
+        since['since_id'] = max(x['id'] for x in posts)
 
     try:
-        posts = api.user_timeline(user_id=profile_id)
-        return [x._json for x in posts]
+        new_posts = timeline(profile_id, **since)
     except tweepy.error.TweepError:
+        metrics.upstream_errors.inc(service='twitter')
+        return posts
+
+    return merge_posts(new_posts, posts, TIMELINE_SIZE)
+
+
+@metrics.timed('twitter_posts')
+@expiring_cache('twitter_posts', 60*60*24*100, refresh=refresh_posts,
+                grace=60*60*24*7, legacy_keys=True)
+def posts_for(profile_id):
+    """Gets the latest 20 posts for the user with the given ID.
+    Uses an expiring cache, refreshed with refresh_posts. Raises
+    RateLimited, rather than caching no posts, if the posts can't be
+    retrieved because of rate limits."""
+    try:
+        return timeline(profile_id)
+    except tweepy.error.TweepError:
+        metrics.upstream_errors.inc(service='twitter')
         return []
 
 
+def timeline(profile_id, **kwargs):
+    """Returns the latest posts for the user with the given ID, taking
+    the user_timeline arguments (such as since_id) given."""
+    posts = call_api('statuses/user_timeline', 'user_timeline',
+                     user_id=profile_id, count=TIMELINE_SIZE, **kwargs)
+    return [x._json for x in posts]
+
+
+# tweepy.API objects keep the last response they received, so each thread
+# keeps its own rather than sharing them.
+_apis = threading.local()
+
+
 def get_api(access_token=access_token,
             access_token_secret=access_token_secret):
-    """Initializes a tweepy-based Twitter API object for a given
-    access token and secret."""
-    auth = tweepy.OAuthHandler(consumer_key=key,
-                               consumer_secret=secret)
-    auth.set_access_token(access_token, access_token_secret)
-    api = tweepy.API(auth, wait_on_rate_limit=True,
-                     wait_on_rate_limit_notify=True)
-
-    return api
+    """Returns a tweepy-based Twitter API object for a given
+    access token and secret. Objects are created once per thread
+    and reused."""
+    if not hasattr(_apis, 'by_token'):
+        _apis.by_token = {}
+
+    token = (access_token, access_token_secret)
+    if token not in _apis.by_token:
+        auth = tweepy.OAuthHandler(consumer_key=key,
+                                   consumer_secret=secret)
+        auth.set_access_token(access_token, access_token_secret)
+        _apis.by_token[token] = tweepy.API(auth)
+
+    return _apis.by_token[token]
+
+
+def call_api(endpoint, method, *args, **kwargs):
+    """Calls a tweepy API method for `endpoint` (as named in Twitter's
+    rate limit documentation) with credentials from the pool, and records
+    the limits in the response. Raises RateLimited instead of waiting if
+    no credential has calls left."""
+    credential = limiter.acquire(endpoint)
+    api = get_api(*credential)
+    api.last_response = None
+
+    try:
+        return getattr(api, method)(*args, **kwargs)
+    except tweepy.error.TweepError:
+        response = api.last_response
+        if response is not None and response.status_code == 429:
+            limiter.exhausted(credential, endpoint,
+                              response.headers.get('x-rate-limit-reset'))
+            return call_api(endpoint, method, *args, **kwargs)
+        raise
+    finally:
+        if api.last_response is not None:
+            limiter.update(credential, endpoint, api.last_response.headers)
@@ -1,56 +1,397 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from time import time
+import os.path
+import threading
+
 from sklearn.externals import joblib
 
 from companyscorer.classifier import NetworkClassifier
 from companyscorer.searchengines import TwitterSearch, FacebookSearch
+from singleflight import SingleFlight
+from simplediskcache.MemoryCache import MemoryCache
+from simplediskcache.keys import normalize_text
 import config
+import metrics
+
+# How long a classifier file must go unmodified before it's reloaded.
+MODEL_SETTLE_SECONDS = 5
+
+# The names in a batch are searched for concurrently on this pool, which is
+# shared by all batches.
+batch_executor = ThreadPoolExecutor(config.batch_search_workers)
+
+
+class DeadlineExceeded(Exception):
+    """Returned in place of the results for a name in a batch that wasn't
+    searched for before the deadline."""
+
+
+class StreamAbandoned(Exception):
+    """Raised to callers waiting on a stream whose consumer stopped reading
+    it before it finished."""
 
 
 class SingleNetworkSearcher(object):
     """Handles searching for and classifying a company's profiles
     on an individual social network."""
 
-    def __init__(self, classifier, searchengine, profile_converter, network):
+    def __init__(self, classifier, searchengine, profile_converter, network,
+                 result_cache=None, model_version=None,
+                 preprocessed_data=None):
         self.engine = searchengine
         self.classifier = NetworkClassifier(classifier, profile_converter,
-                                            network)
+                                            network, preprocessed_data)
         self.network = network
+        self.in_flight = SingleFlight()
+        self.result_cache = result_cache
+        self.model_version = model_version
+
+    def query(self, query, deadline=None):
+        """Returns results for this searcher's network. Results are served
+        from the result cache, if there is one, and concurrent queries for
+        the same normalized name share a single search.
+
+        Profiles whose posts weren't retrieved by `deadline` are classified
+        without them, and the result is marked as partial. Partial results
+        aren't cached. Queries sharing a search wait for it only until their
+        own deadline; see `shared_result`."""
+        key = self.cache_key(query)
+        found, result = self.cached_result(key)
+        if found:
+            return result
 
-    def query(self, query):
-        """Returns results for this searcher's network."""
-        profiles = self.engine.query(query)
-        classified = self.classifier.classify_profiles(name=query,
-                                                       profiles=profiles)
+        future, is_leader = self.in_flight.lead(key)
+        if not is_leader:
+            return self.shared_result(future, query, deadline)
 
+        try:
+            result = self.query_uncached(query, deadline)
+        except Exception as e:
+            self.in_flight.finish(key, exception=e)
+            raise
+
+        self.in_flight.finish(key, result)
+        return result
+
+    def shared_result(self, future, query, deadline=None):
+        """Returns the result of an identical query in progress, waiting for
+        its future until `deadline`. If it hasn't finished by then, an empty
+        partial result is returned. If it's partial because its own deadline
+        was earlier, and there's still time before `deadline`, the query is
+        searched for again."""
+        timeout = None
+        if deadline is not None:
+            timeout = max(0, deadline - time())
+
+        try:
+            result = future.result(timeout)
+        except TimeoutError:
+            return self.classifier.build_result(
+                query, official=[], affiliate=[], unrelated=[])._replace(
+                    partial=True)
+
+        if result.partial and (deadline is None or time() < deadline):
+            return self.query_uncached(query, deadline)
+
+        return result
+
+    def query_uncached(self, query, deadline=None):
+        """Returns results for this searcher's network, without checking
+        the result cache or sharing the search with concurrent queries.
+        The results are stored in the result cache."""
+        with metrics.stage_latency.time(stage=self.network + '_search'):
+            profiles = self.search(query, deadline)
+
+        with metrics.stage_latency.time(stage=self.network + '_classify'):
+            classified = self.classify(query, profiles)
+
+        self.store_result(self.cache_key(query), classified)
         return classified
 
+    def cached_result(self, key):
+        """Returns a (found, result) pair for the results under key in the
+        result cache."""
+        if self.result_cache is None:
+            return False, None
+
+        found, result = self.result_cache.lookup(key)
+        metrics.cache_requests.inc(cache=self.network + '_results',
+                                   result='hit' if found else 'miss')
+        return found, result
+
+    def store_result(self, key, result):
+        """Stores results under key in the result cache, unless they're
+        partial."""
+        if self.result_cache is not None and not result.partial:
+            self.result_cache.set(key, result)
+
+    def preload(self):
+        """Loads the preprocessed feature data for this searcher's
+        network."""
+        self.classifier.feature_data()
+
+    def cache_key(self, query):
+        """Returns the key identifying results for a query, which depend
+        on the network, the normalized query, and the model used."""
+        return (self.network, normalize_query(query), self.model_version)
+
+    def query_many(self, queries, deadline=None):
+        """Given a list of company names, returns a dict keyed by each
+        normalized name, with values being the name's classification
+        result, or the exception raised while searching for it.
+
+        Results in the result cache are used, and names that normalize to
+        the same key are only searched for once. All of the profiles found
+        are classified together, and the results that aren't partial are
+        stored in the result cache. Names are searched for concurrently,
+        with posts retrieved until `deadline` as in `query`; names whose
+        search hasn't finished by then get a DeadlineExceeded exception,
+        and are left to finish in the background."""
+        results = {}
+        searches = OrderedDict()
+        for query in queries:
+            key = normalize_query(query)
+            if key in results or key in searches:
+                continue
+
+            found, result = self.cached_result(self.cache_key(query))
+            if found:
+                results[key] = result
+            else:
+                searches[key] = ' '.join(query.split())
+
+        futures = []
+        for key, query in searches.iteritems():
+            futures.append((key, query, batch_executor.submit(
+                self.search, query, deadline)))
+
+        searched_keys = []
+        named_profiles = []
+        for key, query, future in futures:
+            timeout = None
+            if deadline is not None:
+                timeout = max(0, deadline - time())
+
+            try:
+                named_profiles.append((query, future.result(timeout)))
+                searched_keys.append(key)
+            except TimeoutError:
+                future.cancel()
+                results[key] = DeadlineExceeded(
+                    'Not searched for before the deadline.')
+            except Exception as e:
+                results[key] = e
+
+        classified = self.classifier.classify_many(named_profiles)
+        for key, (query, _), result in zip(searched_keys, named_profiles,
+                                           classified):
+            if not isinstance(result, Exception):
+                self.store_result(self.cache_key(query), result)
+
+            results[key] = result
+
+        return results
+
+    def stream(self, query, deadline=None):
+        """Returns a generator of results for this searcher's network,
+        classifying each profile as soon as it's retrieved. See
+        NetworkClassifier.iter_classify_profiles for what is yielded.
+
+        As with `query`, results in the result cache are used, and a stream
+        shares the results of an identical query or stream in progress
+        rather than searching again; their profiles are then yielded all at
+        once. Streamed results are stored in the result cache."""
+        key = self.cache_key(query)
+        found, result = self.cached_result(key)
+        if found:
+            return iter_result(result)
+
+        return self.stream_shared(key, query, deadline)
+
+    def stream_shared(self, key, query, deadline=None):
+        """Generator for `stream`, for results that aren't cached."""
+        future, is_leader = self.in_flight.lead(key)
+        if not is_leader:
+            for item in iter_result(self.shared_result(future, query,
+                                                       deadline)):
+                yield item
+
+            return
 
-class TwitterSearcher(object):
+        finished = False
+        error = None
+        try:
+            profiles = self.engine.iter_query(query, deadline)
+            for category, entry in self.classifier.iter_classify_profiles(
+                    name=query, profiles=profiles):
+                if category == 'summary':
+                    self.store_result(key, entry)
+                    self.in_flight.finish(key, entry)
+                    finished = True
+
+                yield category, entry
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            if not finished:
+                self.in_flight.finish(key, exception=error or StreamAbandoned(
+                    'The search was abandoned before it finished.'))
+
+    def search(self, query, deadline=None):
+        """Returns the candidate profiles for a query on this searcher's
+        network, without classifying them."""
+        return self.engine.query(query, deadline)
+
+    def feature_labels(self):
+        """Returns the labels for each field in the feature vectors."""
+        return self.classifier.profile_converter.feature_vector_labels()
+
+    def classify(self, query, profiles):
+        """Classifies profiles found by `search`."""
+        return self.classifier.classify_profiles(name=query,
+                                                 profiles=profiles)
+
+
+class ModelSearcher(object):
+    """Wraps a SingleNetworkSearcher whose classifier is loaded from a file.
+    The classifier and its preprocessed data are loaded when first needed,
+    or by `preload`. They can be reloaded while queries are running: the
+    new SingleNetworkSearcher is swapped in only once it's fully loaded, and
+    queries in progress finish with the one they started with."""
+    def __init__(self, network, searchengine, classifier_file):
+        self.network = network
+        self.searchengine = searchengine
+        self.classifier_file = classifier_file
+        self.result_cache = create_result_cache()
+        self.reload_lock = threading.Lock()
+        self.loaded_engine = None
+
+    @property
+    def engine(self):
+        """The SingleNetworkSearcher in use, which is loaded the first time
+        it's needed."""
+        engine = self.loaded_engine
+        if engine is None:
+            with self.reload_lock:
+                if self.loaded_engine is None:
+                    self.loaded_engine = self.load()
+
+                engine = self.loaded_engine
+
+        return engine
+
+    def load(self):
+        """Loads the classifier file and preprocessed data for this
+        searcher's network, returning a SingleNetworkSearcher using them."""
+        model_version = os.path.getmtime(self.classifier_file)
+        classifier = joblib.load(self.classifier_file)
+        preprocessed_data = config.converter.retrieve_preprocessed_data(
+            self.network)
+
+        return SingleNetworkSearcher(
+            classifier=classifier,
+            searchengine=self.searchengine,
+            profile_converter=config.converter,
+            network=self.network,
+            result_cache=self.result_cache,
+            model_version=model_version,
+            preprocessed_data=preprocessed_data
+        )
+
+    def reload(self):
+        """Loads the classifier and preprocessed data again, and swaps them
+        in. Returns the new model version."""
+        with self.reload_lock:
+            engine = self.load()
+            self.loaded_engine = engine
+
+        return engine.model_version
+
+    def model_changed(self):
+        """Returns True if the classifier file has changed since it was
+        loaded. Files modified in the last few seconds may still be being
+        written, so they aren't reported as changed until later. Models
+        that haven't been loaded yet haven't changed."""
+        engine = self.loaded_engine
+        if engine is None:
+            return False
+
+        try:
+            modified = os.path.getmtime(self.classifier_file)
+        except OSError:
+            return False
+
+        return (modified != engine.model_version and
+                time() - modified > MODEL_SETTLE_SECONDS)
+
+    def query(self, query, deadline=None):
+        """Given a company name, returns classified results for that company
+        on this searcher's network."""
+        return self.engine.query(query, deadline)
+
+    def query_many(self, queries, deadline=None):
+        """Given a list of company names, returns classified results for
+        each of them. See SingleNetworkSearcher.query_many."""
+        return self.engine.query_many(queries, deadline)
+
+    def stream(self, query, deadline=None):
+        """Given a company name, returns a generator of classified results
+        for that company, produced one profile at a time."""
+        return self.engine.stream(query, deadline)
+
+    def feature_labels(self):
+        """Returns the labels for each field in the feature vectors."""
+        return self.engine.feature_labels()
+
+    def preload(self):
+        """Loads the classifier and preprocessed feature data, so that the
+        first query doesn't have to."""
+        self.engine.preload()
+
+
+class TwitterSearcher(ModelSearcher):
     """Wraps a SingleNetworkSearcher for Twitter search and classification."""
     def __init__(self):
-        self.engine = SingleNetworkSearcher(
-            classifier=joblib.load('twitter_classifier.pkl'),
+        super(TwitterSearcher, self).__init__(
+            network='twitter',
             searchengine=TwitterSearch(),
-            profile_converter=config.converter,
-            network='twitter'
+            classifier_file='twitter_classifier.pkl'
         )
 
-    def query(self, query):
-        """Given a company name, returns classified results for that company on
-        Twitter."""
-        return self.engine.query(query)
 
-
-class FacebookSearcher(object):
+class FacebookSearcher(ModelSearcher):
     """Wraps a SingleNetworkSearcher for Facebook search and classification."""
     def __init__(self):
-        self.engine = SingleNetworkSearcher(
-            classifier=joblib.load('facebook_classifier.pkl'),
+        super(FacebookSearcher, self).__init__(
+            network='facebook',
             searchengine=FacebookSearch(),
-            profile_converter=config.converter,
-            network='facebook'
+            classifier_file='facebook_classifier.pkl'
         )
 
-    def query(self, query):
-        """Given a company name, returns classified results for that company on
-        Facebook."""
-        return self.engine.query(query)
+
+def normalize_query(query):
+    """Returns a normalized form of a company name, ignoring case and
+    repeated whitespace. Names with the same normalized form are treated
+    as the same company, and share cached API results."""
+    return normalize_text(query)
+
+
+def iter_result(result):
+    """Yields a (category, entry) pair for each profile in a classification
+    result, followed by ('summary', result), as
+    NetworkClassifier.iter_classify_profiles does."""
+    for category in ('official', 'affiliate', 'unrelated'):
+        for entry in getattr(result, category):
+            yield category, entry
+
+    yield 'summary', result
+
+
+def create_result_cache():
+    """Returns an in-memory cache for classification results, configured
+    from config.py."""
+    return MemoryCache(max_size=config.result_cache_size,
+                       ttl=config.result_cache_ttl,
+                       policy=config.result_cache_policy)
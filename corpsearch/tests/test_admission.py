@@ -0,0 +1,111 @@
+import pytest
+from tornado.testing import AsyncTestCase, AsyncHTTPTestCase, gen_test
+
+from .. import app, admission, admit
+from ..admission import AdmissionController, Overloaded
+
+
+class TestAdmissionController(AsyncTestCase):
+    @gen_test
+    def test_rejected_when_queue_full(self):
+        """Tests that requests beyond the queue are rejected straight away,
+        and admitted again once a slot is released."""
+        controller = AdmissionController('test', max_concurrent=1,
+                                         max_queue=0, retry_after=7)
+        slot = yield controller.acquire()
+
+        with pytest.raises(Overloaded) as e:
+            yield controller.acquire()
+
+        assert e.value.status_code == 503
+        assert e.value.retry_after == 7
+
+        slot.release()
+        with (yield controller.acquire()):
+            assert controller.running == 1
+
+        assert controller.running == 0
+
+    @gen_test
+    def test_rejected_when_wait_times_out(self):
+        """Tests that queued requests are rejected if no slot is released
+        within the queue timeout."""
+        controller = AdmissionController('test', max_concurrent=1,
+                                         max_queue=1, queue_timeout=0.01)
+        with (yield controller.acquire()):
+            with pytest.raises(Overloaded):
+                yield controller.acquire()
+
+            assert controller.waiting == 0
+
+
+class RecordingController(AdmissionController):
+    """AdmissionController that records the order slots are taken in."""
+    def __init__(self, name, order):
+        super(RecordingController, self).__init__(name, max_concurrent=1,
+                                                  max_queue=0)
+        self.order = order
+
+    def acquire(self):
+        self.order.append(self.name)
+        return super(RecordingController, self).acquire()
+
+
+class TestAdmit(AsyncTestCase):
+    def setUp(self):
+        super(TestAdmit, self).setUp()
+        self.order = []
+        self.original = dict(admission)
+        admission.update((x, RecordingController(x, self.order))
+                         for x in ('twitter', 'facebook'))
+
+    def tearDown(self):
+        admission.update(self.original)
+        super(TestAdmit, self).tearDown()
+
+    @gen_test
+    def test_slots_taken_in_sorted_order(self):
+        """Tests that slots for several networks are taken in the same
+        order, whatever order the networks are given in."""
+        with (yield admit(['twitter', 'facebook'])):
+            assert admission['twitter'].running == 1
+            assert admission['facebook'].running == 1
+
+        assert self.order == ['facebook', 'twitter']
+        assert admission['twitter'].running == 0
+        assert admission['facebook'].running == 0
+
+    @gen_test
+    def test_slots_released_when_rejected(self):
+        """Tests that slots already taken are released if a later one
+        can't be."""
+        slot = yield admission['twitter'].acquire()
+
+        with pytest.raises(Overloaded):
+            yield admit(['twitter', 'facebook'])
+
+        assert admission['facebook'].running == 0
+        slot.release()
+
+
+class TestOverloadedResponse(AsyncHTTPTestCase):
+    def get_app(self):
+        return app
+
+    def test_503_with_retry_after(self):
+        """Tests that requests rejected by admission control get a 503
+        response, with a Retry-After header rounded up to whole
+        seconds."""
+        controller = AdmissionController('twitter', max_concurrent=1,
+                                         max_queue=0, retry_after=2.5)
+        self.io_loop.run_sync(controller.acquire)
+
+        original = admission['twitter']
+        admission['twitter'] = controller
+        try:
+            response = self.fetch('/company/apple/twitter')
+        finally:
+            admission['twitter'] = original
+
+        assert response.code == 503
+        assert response.headers['Retry-After'] == '3'
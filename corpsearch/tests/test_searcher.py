@@ -0,0 +1,120 @@
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+import threading
+
+from ..searcher import SingleNetworkSearcher
+from simplediskcache.MemoryCache import MemoryCache
+from .test_singleflight import JoinCountingFlight
+
+
+class Profile(object):
+    """Stands in for a social profile."""
+    def __init__(self, partial):
+        self.partial = partial
+
+
+class BlockingSearch(object):
+    """Search engine that finds a single profile once released. The profile
+    is partial if the search had a deadline."""
+    def __init__(self):
+        self.release = threading.Event()
+        self.calls = 0
+
+    def query(self, query, deadline=None):
+        self.calls += 1
+        self.release.wait()
+        return [Profile(partial=deadline is not None)]
+
+
+class Unrelated(object):
+    """Classifier that finds every profile unrelated."""
+    def predict_proba(self, vectors):
+        return [[1.0, 0.0, 0.0] for _ in vectors]
+
+    def predict(self, vectors):
+        return [0 for _ in vectors]
+
+
+class Converter(object):
+    """Profile converter with a single, constant feature."""
+    def convert_to_feature_vector(self, query, profile, data=None):
+        return [0]
+
+    def feature_vector_labels(self):
+        return ['Constant']
+
+
+def create_searcher(engine, result_cache=None):
+    """Returns a searcher using `engine`, whose shared searches can be
+    waited on through its `in_flight.joined` semaphore."""
+    searcher = SingleNetworkSearcher(classifier=Unrelated(),
+                                     searchengine=engine,
+                                     profile_converter=Converter(),
+                                     network='twitter',
+                                     result_cache=result_cache,
+                                     preprocessed_data={})
+    searcher.in_flight = JoinCountingFlight()
+    return searcher
+
+
+def test_shared_search_waited_on_until_deadline():
+    """Tests that a query sharing a search in progress gets an empty
+    partial result once its deadline passes, rather than waiting for the
+    search to finish."""
+    engine = BlockingSearch()
+    searcher = create_searcher(engine)
+    executor = ThreadPoolExecutor(1)
+
+    leader = executor.submit(searcher.query, 'Apple')
+    searcher.in_flight.joined.acquire()
+
+    start = time()
+    result = searcher.query('apple ', deadline=time() + 0.1)
+    assert time() - start < 1
+    assert result.partial
+    assert result.unrelated == []
+
+    engine.release.set()
+    assert len(leader.result().unrelated) == 1
+    assert not leader.result().partial
+    assert engine.calls == 1
+    executor.shutdown()
+
+
+def test_partial_shared_result_searched_again():
+    """Tests that a query without a deadline searches again rather than
+    returning the partial result of a query with one."""
+    engine = BlockingSearch()
+    searcher = create_searcher(engine)
+    executor = ThreadPoolExecutor(2)
+
+    leader = executor.submit(searcher.query, 'Apple', time() + 10)
+    searcher.in_flight.joined.acquire()
+    follower = executor.submit(searcher.query, 'apple')
+    searcher.in_flight.joined.acquire()
+
+    engine.release.set()
+    assert leader.result().partial
+    assert not follower.result().partial
+    assert engine.calls == 2
+    executor.shutdown()
+
+
+def test_batch_uses_result_cache():
+    """Tests that batches use cached results, and cache the results they
+    find unless they're partial."""
+    engine = BlockingSearch()
+    engine.release.set()
+    searcher = create_searcher(engine, MemoryCache())
+
+    results = searcher.query_many(['Apple', 'apple ', 'Banana'])
+    assert sorted(results) == ['apple', 'banana']
+    assert engine.calls == 2
+
+    assert searcher.query_many(['APPLE']) == {'apple': results['apple']}
+    assert searcher.query('Banana') == results['banana']
+    assert engine.calls == 2
+
+    searcher.query_many(['Cherry'], time() + 10)
+    searcher.query_many(['Cherry'], time() + 10)
+    assert engine.calls == 4
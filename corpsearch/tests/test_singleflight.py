@@ -0,0 +1,71 @@
+from concurrent.futures import ThreadPoolExecutor
+import threading
+
+import pytest
+
+from singleflight import SingleFlight
+
+
+class JoinCountingFlight(SingleFlight):
+    """SingleFlight that counts the callers that have joined a call, so
+    that tests can wait for them."""
+    def __init__(self):
+        super(JoinCountingFlight, self).__init__()
+        self.joined = threading.Semaphore(0)
+
+    def lead(self, key):
+        result = super(JoinCountingFlight, self).lead(key)
+        self.joined.release()
+        return result
+
+
+def test_concurrent_calls_coalesced():
+    """Tests that concurrent calls with the same key make a single call,
+    and share its result."""
+    flight = JoinCountingFlight()
+    release = threading.Event()
+    calls = []
+
+    def double(x):
+        calls.append(x)
+        release.wait()
+        return x * 2
+
+    executor = ThreadPoolExecutor(4)
+    futures = [executor.submit(flight.do, 'key', double, x)
+               for x in range(4)]
+    for _ in futures:
+        flight.joined.acquire()
+
+    assert flight.in_progress() == 1
+    release.set()
+
+    results = [x.result() for x in futures]
+    executor.shutdown()
+
+    assert len(calls) == 1
+    assert results == [calls[0] * 2] * 4
+    assert flight.in_progress() == 0
+
+
+def test_exceptions_raised_to_every_caller():
+    """Tests that an exception raised by the call is raised to all of the
+    callers sharing it, and that the next call is made again."""
+    flight = JoinCountingFlight()
+    future, is_leader = flight.lead('key')
+    assert is_leader
+
+    executor = ThreadPoolExecutor(1)
+    follower = executor.submit(flight.do, 'key', lambda: 1)
+    flight.joined.acquire()
+    flight.joined.acquire()
+
+    flight.finish('key', exception=ValueError('Search failed.'))
+    with pytest.raises(ValueError):
+        follower.result()
+
+    with pytest.raises(ValueError):
+        future.result()
+
+    executor.shutdown()
+    assert flight.do('key', lambda: 1) == 1
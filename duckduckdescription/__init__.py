@@ -1,39 +1,73 @@
 import requests
 from simplediskcache.SimpleDiskCache import expiring_cache
+from simplediskcache.keys import normalized, normalize_text
+from singleflight import SingleFlight
+import httpclient
+import metrics
+
+# Concurrent lookups of the same company share a single one, such as those
+# made while classifying the company's profiles on each network.
+in_flight = SingleFlight()
 
 
 class DuckDuckDescription(object):
     """Searches DuckDuckGo for a company, and returns
-    instant answer information for that company."""
+    instant answer information for that company.
+
+    While replaying (see `replay`), descriptions are served from a stored
+    set instead, so that evaluations don't need network access."""
+
+    replayed = None
 
     @staticmethod
-    @expiring_cache('ddg', 60*60*24*90)
     def query(company):
-        """Searches the DuckDuckGo Instant Answer API for ``company``
-        and returns a description for it."""
-        query_params = {
-            'q': company,
-            'format': 'json',
-            'skip_disambig': 1,
-            't': 'CorpSearch'
-        }
+        """Returns the DuckDuckGo description for ``company``, or None if
+        there isn't one."""
+        if DuckDuckDescription.replayed is not None:
+            return DuckDuckDescription.replayed.get(normalize_text(company))
 
-        r = requests.get('https://api.duckduckgo.com/',
-                         params=query_params)
+        return in_flight.do(normalize_text(company), query_instant_answer,
+                            company)
+
+    @staticmethod
+    def replay(descriptions):
+        """Serves all further queries from ``descriptions``, a dictionary of
+        descriptions keyed by company, ignoring case and extra whitespace.
+        Companies that aren't in it have no description."""
+        DuckDuckDescription.replayed = dict(
+            (normalize_text(company), description)
+            for company, description in descriptions.iteritems())
 
-        if r.text == '':
-            import pdb; pdb.set_trace()
 
+@metrics.timed('ddg')
+@expiring_cache('ddg', 60*60*24*90, grace=60*60*24*7,
+                key_func=normalized('company'), legacy_keys=True)
+def query_instant_answer(company):
+    """Searches the DuckDuckGo Instant Answer API for ``company``
+    and returns a description for it."""
+    query_params = {
+        'q': company,
+        'format': 'json',
+        'skip_disambig': 1,
+        't': 'CorpSearch'
+    }
+
+    try:
+        r = httpclient.get('https://api.duckduckgo.com/',
+                           params=query_params)
         response = r.json()
+    except (requests.RequestException, ValueError):
+        metrics.upstream_errors.inc(service='duckduckgo')
+        raise
 
-        if response['Entity'] == 'company':
-            return {
-                'name': response['Heading'],
-                'description': {
-                    'text': response['AbstractText'],
-                    'source': response['AbstractSource'],
-                    'link': response['AbstractURL']
-                }
+    if response['Entity'] == 'company':
+        return {
+            'name': response['Heading'],
+            'description': {
+                'text': response['AbstractText'],
+                'source': response['AbstractSource'],
+                'link': response['AbstractURL']
             }
+        }
 
-        return None
+    return None
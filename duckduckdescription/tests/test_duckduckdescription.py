@@ -0,0 +1,65 @@
+from concurrent.futures import ThreadPoolExecutor
+import threading
+
+import pytest
+
+from singleflight import SingleFlight
+import duckduckdescription
+from .. import DuckDuckDescription
+
+
+@pytest.fixture
+def in_flight(monkeypatch):
+    """Replaces the SingleFlight that lookups share with one that counts
+    the lookups that have joined it, in its `joined` semaphore."""
+    flight = SingleFlight()
+    flight.joined = threading.Semaphore(0)
+    lead = flight.lead
+
+    def counting_lead(key):
+        result = lead(key)
+        flight.joined.release()
+        return result
+
+    flight.lead = counting_lead
+    monkeypatch.setattr(duckduckdescription, 'in_flight', flight)
+    return flight
+
+
+def test_concurrent_lookups_shared(monkeypatch, in_flight):
+    """Tests that concurrent lookups of the same company, ignoring case and
+    whitespace, make a single request."""
+    release = threading.Event()
+    calls = []
+
+    def lookup(company):
+        calls.append(company)
+        release.wait()
+        return {'name': 'Apple'}
+
+    monkeypatch.setattr(duckduckdescription, 'query_instant_answer', lookup)
+
+    executor = ThreadPoolExecutor(3)
+    futures = [executor.submit(DuckDuckDescription.query, x)
+               for x in ['apple', 'Apple ', 'APPLE']]
+    for _ in futures:
+        in_flight.joined.acquire()
+
+    release.set()
+    assert [x.result() for x in futures] == [{'name': 'Apple'}] * 3
+    assert len(calls) == 1
+    executor.shutdown()
+
+
+def test_replayed_descriptions(monkeypatch):
+    """Tests that replayed descriptions are served without making
+    requests."""
+    def lookup(company):
+        raise AssertionError('Looked up ' + company)
+
+    monkeypatch.setattr(duckduckdescription, 'query_instant_answer', lookup)
+    monkeypatch.setattr(DuckDuckDescription, 'replayed', None)
+
+    DuckDuckDescription.replay({'Apple Inc.': {'name': 'Apple'}})
+    assert DuckDuckDescription.query('apple  inc.') == {'name': 'Apple'}
+    assert DuckDuckDescription.query('Banana') is None
@@ -4,6 +4,7 @@ import itertools
 import time
 import argparse
 import cPickle
+import json
 import os.path
 
 from pathos.multiprocessing import ProcessingPool
@@ -19,8 +20,10 @@ from trainer.trainer import Trainer, get_facebook_entries, get_twitter_entries
 from trainer.social_profile import TwitterProfile, FacebookProfile
 from corpsearch.searcher import SingleNetworkSearcher
 from corpsearch.companyscorer.searchengines import TwitterSearch,\
-                                                   FacebookSearch
+                                                   FacebookSearch,\
+                                                   ReplaySearch
 from trainer.converters import all_converters
+from duckduckdescription import DuckDuckDescription
 import config
 
 
@@ -606,16 +609,79 @@ class MetricCalculator(object):
         }
 
 
-def evaluate_and_print():
+def load_network(network, replay=None):
+    """Returns the labelled entries to evaluate a network's classifier on,
+    and the search engine to use. With `replay` set to 'mongo', searches are
+    served from the search results stored in MongoDB. With `replay` set to
+    a directory, both come from the snapshot exported there by
+    `export_snapshots`, and DuckDuckGo descriptions are replayed from it,
+    so that MongoDB and the network aren't needed. Otherwise, the live
+    search engine is used."""
+    if replay is None or replay == 'mongo':
+        entries = {
+            'twitter': get_twitter_entries,
+            'facebook': get_facebook_entries
+        }[network]()
+
+        if replay is None:
+            search_engine = {
+                'twitter': TwitterSearch,
+                'facebook': FacebookSearch
+            }[network]()
+        else:
+            search_engine = ReplaySearch.from_mongo(network)
+
+        return entries, search_engine
+
+    with open(descriptions_file(replay)) as snapshot:
+        DuckDuckDescription.replay(json.load(snapshot))
+
+    search_engine = ReplaySearch.from_file(snapshot_file(replay, network))
+    return search_engine.entries(), search_engine
+
+
+def snapshot_file(directory, network):
+    """Returns the path to a network's snapshot in a directory."""
+    return os.path.join(directory, network + '.json')
+
+
+def descriptions_file(directory):
+    """Returns the path to the DuckDuckGo descriptions in a snapshot
+    directory."""
+    return os.path.join(directory, 'descriptions.json')
+
+
+def export_snapshots(directory):
+    """Exports the search results stored in MongoDB for each network to
+    a snapshot in `directory`, for offline evaluation, along with the
+    DuckDuckGo descriptions of the companies searched for."""
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    queries = set()
+    for network in ['twitter', 'facebook']:
+        print 'Exporting', network
+        search_engine = ReplaySearch.from_mongo(network)
+        search_engine.export(snapshot_file(directory, network))
+        queries.update(search_engine.results)
+
+    print 'Exporting DuckDuckGo descriptions'
+    descriptions = dict((query, DuckDuckDescription.query(query.lower()))
+                        for query in queries)
+    with open(descriptions_file(directory), 'w') as snapshot:
+        json.dump(descriptions, snapshot)
+
+
+def evaluate_and_print(replay=None):
     """Evaluates the system and outputs per-network results to separate
-    CSV files."""
+    CSV files. See `load_network` for `replay`."""
     printer = pretty_print_summary
 
-    twitter_entries = get_twitter_entries()
+    twitter_entries, twitter_search = load_network('twitter', replay)
     twitter_start_time = int(time.time())
     print 'Evaluating Twitter', twitter_start_time
     twitter_evaluator = Evaluator(twitter_entries, TwitterProfile,
-                                  TwitterSearch(), 'twitter')
+                                  twitter_search, 'twitter')
     twitter_results = twitter_evaluator.evaluate()
     twitter_end_time = int(time.time())
     twitter_lines = ['\n' + x for x in printer('Twitter', twitter_results)]
@@ -626,11 +692,11 @@ def evaluate_and_print():
     with open('twitter_evaluation_results.csv', 'w') as twitter_result_file:
         twitter_result_file.writelines(twitter_lines)
 
-    facebook_entries = get_facebook_entries()
+    facebook_entries, facebook_search = load_network('facebook', replay)
     facebook_start_time = int(time.time())
     print 'Evaluating Facebook', facebook_start_time
     facebook_evaluator = Evaluator(facebook_entries, FacebookProfile,
-                                   FacebookSearch(), 'facebook')
+                                   facebook_search, 'facebook')
     facebook_results = facebook_evaluator.evaluate()
     facebook_end_time = int(time.time())
     facebook_lines = ['\n' + x for x in printer('Facebook', facebook_results)]
@@ -657,18 +723,20 @@ def process_network_results(results):
     return result.process()
 
 
-def evaluate_to_file(converter=config.evaluate_converter, idx=0):
+def evaluate_to_file(converter=config.evaluate_converter, idx=0,
+                     replay=None):
     """Evaluates the performance of the system, and saves the results
-    to data files in network-specific folders."""
+    to data files in network-specific folders. See `load_network` for
+    `replay`."""
     name = converter.name
     basedir = os.path.dirname(__file__)
     results_directory = os.path.join(basedir, 'results')
 
-    twitter_entries = get_twitter_entries()
+    twitter_entries, twitter_search = load_network('twitter', replay)
     twitter_start_time = int(time.time())
     print 'Evaluating Twitter', name, twitter_start_time
     twitter_evaluator = Evaluator(twitter_entries, TwitterProfile,
-                                  TwitterSearch(), 'twitter',
+                                  twitter_search, 'twitter',
                                   converter=converter)
     twitter_results = twitter_evaluator.evaluate()
     twitter_end_time = int(time.time())
@@ -681,11 +749,11 @@ def evaluate_to_file(converter=config.evaluate_converter, idx=0):
     print 'Done', twitter_end_time, '. Total',\
           twitter_end_time - twitter_start_time
 
-    facebook_entries = get_facebook_entries()
+    facebook_entries, facebook_search = load_network('facebook', replay)
     facebook_start_time = int(time.time())
     print 'Evaluating Facebook', facebook_start_time
     facebook_evaluator = Evaluator(facebook_entries, FacebookProfile,
-                                   FacebookSearch(), 'facebook',
+                                   facebook_search, 'facebook',
                                    converter=converter)
     facebook_results = facebook_evaluator.evaluate()
     facebook_end_time = int(time.time())
@@ -700,19 +768,20 @@ def evaluate_to_file(converter=config.evaluate_converter, idx=0):
 
 
 def evaluate_statistical_significance(converter=config.evaluate_converter,
-                                      idx=0):
+                                      idx=0, replay=None):
     """Evaluates the performance of the system in terms of number of correct
     results, and saves the results to data files in network-specific folders.
-    Used to determine if feature sets show statistical significance."""
+    Used to determine if feature sets show statistical significance.
+    See `load_network` for `replay`."""
     name = converter.__name__
     basedir = os.path.dirname(__file__)
     results_directory = os.path.join(basedir, 'results')
 
-    twitter_entries = get_twitter_entries()
+    twitter_entries, twitter_search = load_network('twitter', replay)
     twitter_start_time = int(time.time())
     print 'Evaluating Twitter', name, twitter_start_time
     twitter_evaluator = Evaluator(twitter_entries, TwitterProfile,
-                                  TwitterSearch(), 'twitter',
+                                  twitter_search, 'twitter',
                                   converter=converter)
     twitter_results = twitter_evaluator.evaluate_statistical()
     twitter_end_time = int(time.time())
@@ -723,11 +792,11 @@ def evaluate_statistical_significance(converter=config.evaluate_converter,
     print 'Done', twitter_end_time, '. Total',\
           twitter_end_time - twitter_start_time
 
-    facebook_entries = get_facebook_entries()
+    facebook_entries, facebook_search = load_network('facebook', replay)
     facebook_start_time = int(time.time())
     print 'Evaluating Facebook', facebook_start_time
     facebook_evaluator = Evaluator(facebook_entries, FacebookProfile,
-                                   FacebookSearch(), 'facebook',
+                                   facebook_search, 'facebook',
                                    converter=converter)
     facebook_results = facebook_evaluator.evaluate_statistical()
     facebook_end_time = int(time.time())
@@ -741,14 +810,27 @@ def evaluate_statistical_significance(converter=config.evaluate_converter,
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('type', choices=['config', 'all', 'statistical'])
+    parser.add_argument('type', choices=['config', 'all', 'statistical',
+                                         'snapshot'])
+    parser.add_argument('--offline', action='store_true',
+                        help='serve searches from the search results stored '
+                             'in MongoDB, rather than the live APIs')
+    parser.add_argument('--snapshot', metavar='DIRECTORY',
+                        help='evaluate on the snapshot in DIRECTORY, without '
+                             'MongoDB or the live APIs; with the snapshot '
+                             'type, export the snapshot to DIRECTORY')
     args = parser.parse_args()
 
+    replay = args.snapshot or ('mongo' if args.offline else None)
+
     if args.type == 'config':
-        evaluate_to_file()
+        evaluate_to_file(replay=replay)
     elif args.type == 'all':
         for idx, converter in enumerate(all_converters):
-            evaluate_to_file(converter, idx + 1)
+            evaluate_to_file(converter, idx + 1, replay=replay)
     elif args.type == 'statistical':
         for idx, converter in enumerate(all_converters):
-            evaluate_statistical_significance(converter, idx + 1)
+            evaluate_statistical_significance(converter, idx + 1,
+                                              replay=replay)
+    elif args.type == 'snapshot':
+        export_snapshots(args.snapshot or 'snapshot')
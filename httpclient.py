@@ -0,0 +1,60 @@
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from lazyconfig import config
+
+# Sessions keep connections alive between requests, so that each request
+# doesn't pay for a new TCP connection and TLS handshake. One session is
+# shared by all threads in a process; requests' connection pools are
+# thread-safe.
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+
+def session():
+    """Returns the shared requests Session for this process, creating it
+    with the pool size configured in config.py if needed. Forked processes
+    get their own session rather than sharing the parent's connections."""
+    global _session, _session_pid
+
+    if _session is not None and _session_pid == os.getpid():
+        return _session
+
+    with _session_lock:
+        if _session is None or _session_pid != os.getpid():
+            adapter = HTTPAdapter(pool_connections=config.http_pool_size,
+                                  pool_maxsize=config.http_pool_size,
+                                  max_retries=config.http_retries)
+            new_session = requests.Session()
+            new_session.mount('http://', adapter)
+            new_session.mount('https://', adapter)
+
+            _session = new_session
+            _session_pid = os.getpid()
+
+    return _session
+
+
+def get(url, **kwargs):
+    """Makes a GET request with the shared session, using the timeout in
+    config.py unless one is given."""
+    return session().get(url, **with_default_timeout(kwargs))
+
+
+def post(url, **kwargs):
+    """Makes a POST request with the shared session, using the timeout in
+    config.py unless one is given."""
+    return session().post(url, **with_default_timeout(kwargs))
+
+
+def with_default_timeout(kwargs):
+    """Returns request keyword arguments with the configured timeout set,
+    if they don't have one."""
+    if 'timeout' not in kwargs:
+        kwargs = dict(kwargs, timeout=config.http_timeout)
+
+    return kwargs
@@ -0,0 +1,15 @@
+class LazyConfig(object):
+    """Stands in for the config module in modules that config itself
+    imports, such as simplediskcache and httpclient, where importing config
+    directly would be circular. config is imported the first time a setting
+    is read, by which time it has finished loading.
+
+        from lazyconfig import config
+        config.http_timeout
+    """
+    def __getattr__(self, name):
+        import config as settings
+        return getattr(settings, name)
+
+
+config = LazyConfig()
@@ -0,0 +1,256 @@
+from bisect import bisect_left
+from time import time
+import functools
+import threading
+
+# Upper bounds, in seconds, of the latency histogram buckets.
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+                   2.5, 5.0, 10.0, 30.0, 60.0)
+
+registry = []
+
+
+class Metric(object):
+    """Base class for metrics, which hold a value per combination of label
+    values, and can be rendered in the Prometheus text format."""
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}
+        registry.append(self)
+
+    def label_values(self, labels):
+        """Returns the tuple of label values for the given label
+        keyword arguments."""
+        return tuple(unicode(labels[x]) for x in self.labelnames)
+
+    def samples(self):
+        """Returns a list of (suffix, labels, value) tuples, where labels is a
+        list of (name, value) pairs."""
+        with self.lock:
+            values = self.values.items()
+
+        return [('', zip(self.labelnames, x), value)
+                for x, value in sorted(values)]
+
+    def render(self):
+        """Returns the lines describing this metric in the Prometheus text
+        format."""
+        lines = [
+            '# HELP %s %s' % (self.name, self.documentation),
+            '# TYPE %s %s' % (self.name, self.kind)
+        ]
+
+        for suffix, labels, value in self.samples():
+            lines.append('%s%s%s %s' % (self.name, suffix,
+                                        format_labels(labels),
+                                        format_value(value)))
+
+        return lines
+
+
+class Counter(Metric):
+    """A value that only goes up, e.g. the number of errors."""
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        """Increments the counter for the given labels."""
+        key = self.label_values(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """A value that can go up and down, e.g. the size of a cache. A gauge's
+    values can also be computed when it's rendered, by a function given to
+    `set_function` that returns a dictionary keyed by label value tuples."""
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super(Gauge, self).__init__(name, documentation, labelnames)
+        self.function = None
+
+    def set(self, value, **labels):
+        """Sets the gauge's value for the given labels."""
+        key = self.label_values(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def set_function(self, function):
+        """Computes the gauge's values with `function` at render time."""
+        self.function = function
+
+    def samples(self):
+        if self.function is None:
+            return super(Gauge, self).samples()
+
+        values = self.function()
+        return [('', zip(self.labelnames, x), value)
+                for x, value in sorted(values.items())]
+
+
+class Histogram(Metric):
+    """Counts observations, such as latencies, into buckets."""
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=LATENCY_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        """Records an observation for the given labels."""
+        key = self.label_values(labels)
+        with self.lock:
+            counts, total = self.values.get(
+                key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect_left(self.buckets, value)] += 1
+            self.values[key] = (counts, total + value)
+
+    def time(self, **labels):
+        """Returns a context manager that observes the time taken by the
+        block it wraps."""
+        return Timer(self, labels)
+
+    def samples(self):
+        with self.lock:
+            values = [(x, (list(counts), total))
+                      for x, (counts, total) in self.values.items()]
+
+        samples = []
+        for label_values, (counts, total) in sorted(values):
+            labels = zip(self.labelnames, label_values)
+
+            cumulative = 0
+            bounds = [format_value(x) for x in self.buckets] + ['+Inf']
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                samples.append(('_bucket', labels + [('le', bound)],
+                                cumulative))
+
+            samples.append(('_sum', labels, total))
+            samples.append(('_count', labels, cumulative))
+
+        return samples
+
+
+class Timer(object):
+    """Context manager that records the time taken by the block it wraps
+    in a histogram."""
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+        self.start = None
+
+    def __enter__(self):
+        self.start = time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(time() - self.start, **self.labels)
+
+
+def format_labels(labels):
+    """Formats a list of (name, value) label pairs."""
+    if not labels:
+        return ''
+
+    escaped = (u'%s="%s"' % (name, value.replace('\\', '\\\\')
+                                        .replace('"', '\\"')
+                                        .replace('\n', '\\n'))
+               for name, value in labels)
+    return u'{' + u','.join(escaped) + u'}'
+
+
+def format_value(value):
+    """Formats a sample value."""
+    return repr(float(value))
+
+
+def render():
+    """Returns all registered metrics in the Prometheus text format."""
+    lines = []
+    for metric in registry:
+        lines += metric.render()
+
+    return u'\n'.join(lines) + u'\n'
+
+
+def timed(stage):
+    """Decorator that records the time taken by each call to the given
+    function under `stage` in the stage latency histogram."""
+    def wrapper(func):
+        @functools.wraps(func)
+        def timer(*args, **kwargs):
+            with stage_latency.time(stage=stage):
+                return func(*args, **kwargs)
+
+        return timer
+
+    return wrapper
+
+
+stage_latency = Histogram('corpsearch_stage_latency_seconds',
+                          'Time spent in each stage of a query.',
+                          ['stage'])
+
+request_latency = Histogram('corpsearch_request_latency_seconds',
+                            'Time taken to handle requests, per handler.',
+                            ['handler', 'status'])
+
+cache_requests = Counter('corpsearch_cache_requests_total',
+                         'Cache lookups, per cache and result '
+                         '(hit, miss, stale, or expired).',
+                         ['cache', 'result'])
+
+memory_cache_entries = Gauge('corpsearch_memory_cache_entries',
+                             'Entries in the in-process cache in front of '
+                             'each MongoDB cache.',
+                             ['cache'])
+
+cache_refreshes = Counter('corpsearch_cache_refreshes_total',
+                          'Cached results refreshed in the background, per '
+                          'cache and result (ok or error).',
+                          ['cache', 'result'])
+
+upstream_errors = Counter('corpsearch_upstream_errors_total',
+                          'Errors returned by upstream services.',
+                          ['service'])
+
+rate_limited = Counter('corpsearch_rate_limited_total',
+                       'Upstream calls refused because no credential had '
+                       'calls left, per service.',
+                       ['service'])
+
+result_cache_entries = Gauge('corpsearch_result_cache_entries',
+                             'Classification results cached in memory, '
+                             'per network.',
+                             ['network'])
+
+admission_running = Gauge('corpsearch_admission_running',
+                          'Pipeline executions in progress, per network.',
+                          ['network'])
+
+admission_waiting = Gauge('corpsearch_admission_waiting',
+                          'Requests waiting to start a pipeline execution, '
+                          'per network.',
+                          ['network'])
+
+admission_rejected = Counter('corpsearch_admission_rejected_total',
+                             'Requests rejected because too many were in '
+                             'progress or waiting, per network.',
+                             ['network'])
+
+preprocessed_data_load_seconds = Gauge(
+    'corpsearch_preprocessed_data_load_seconds',
+    'Time taken to last load the preprocessed feature data, per network.',
+    ['network'])
+
+preprocessed_data_bytes = Gauge(
+    'corpsearch_preprocessed_data_bytes',
+    'Size of the files the preprocessed feature data was loaded from.',
+    ['network'])
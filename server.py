@@ -1,7 +1,335 @@
-import tornado.ioloop
+import argparse
+import errno
+import gc
+import os
+import signal
+import sys
+import time
+
+from tornado import gen
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.netutil import bind_sockets
+from tornado.process import cpu_count
+
+from tornado.log import app_log
+
+from corpsearch import app, preload, reload_models, executor, BaseHandler
+from simplediskcache.SimpleDiskCache import refresh_hot_keys, prepare_caches
+import config
+
+# Workers exit with this code after a graceful restart (SIGHUP), so that the
+# parent process starts a replacement. Workers that exit with 0 (SIGTERM)
+# aren't replaced.
+RESTART_EXIT_CODE = 3
+
+# Signals the parent process handles for its workers.
+SUPERVISED_SIGNALS = (signal.SIGTERM, signal.SIGHUP, signal.SIGUSR1)
+
+# How often, in seconds, the parent process checks whether workers have
+# exited. Signals are handled straight away.
+SUPERVISE_INTERVAL = 0.5
+
+
+class Supervisor(object):
+    """Forks worker processes and keeps them running. Workers that exit
+    after a graceful restart are replaced, as are workers that crash, up to
+    `max_restarts` times in all; workers that shut down aren't.
+
+    SIGTERM is passed on to every worker, and only to workers, as they may
+    share a process group with other processes, such as a shell or make.
+    SIGHUP restarts the workers one at a time, each once the one before it
+    has exited, so that the others keep serving in the meantime.
+
+    Models are loaded in this process, and shared by the workers forked
+    from it. `reload_models(only_changed)` is called on SIGUSR1, and every
+    `watch_interval` seconds with only_changed set, and returns the models
+    it reloaded; if there are any, the workers are restarted as for SIGHUP,
+    so that their replacements share the new models too."""
+    def __init__(self, processes, max_restarts, reload_models=None,
+                 watch_interval=None):
+        self.processes = processes or cpu_count()
+        self.max_restarts = max_restarts
+        self.crashes = 0
+        self.reload_models = reload_models
+        self.watch_interval = watch_interval
+        self.next_watch = None
+
+        # Task IDs of the running workers, keyed by process ID.
+        self.workers = {}
+        self.stopping = False
+
+        # Workers waiting to be restarted, and the one restarting.
+        self.restart_queue = []
+        self.restarting = None
+
+        # Signals received, which are handled between waits for workers.
+        self.signals = []
+
+    def run(self):
+        """Forks the workers, and supervises them until they've all shut
+        down. Returns the task ID in a worker process, and None in the
+        parent once the workers are done."""
+        for signum in SUPERVISED_SIGNALS:
+            signal.signal(signum, self.handle_signal)
+
+        for task_id in xrange(self.processes):
+            if self.start_worker(task_id):
+                return task_id
+
+        if self.reload_models is not None and self.watch_interval:
+            self.next_watch = time.time() + self.watch_interval
+
+        while self.workers:
+            self.handle_signals()
+            if self.next_watch is not None and time.time() >= self.next_watch:
+                self.next_watch = time.time() + self.watch_interval
+                self.reload(only_changed=True)
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno != errno.EINTR:
+                    raise
+                continue
+
+            if pid == 0:
+                # Signals cut the sleep short.
+                time.sleep(SUPERVISE_INTERVAL)
+            elif self.worker_exited(pid, status):
+                return self.task_id
+
+        return None
+
+    def start_worker(self, task_id):
+        """Forks a worker with the given task ID. Returns True in the
+        worker process, and False in the parent."""
+        pid = os.fork()
+        if pid == 0:
+            for signum in SUPERVISED_SIGNALS:
+                signal.signal(signum, signal.SIG_DFL)
+
+            self.task_id = task_id
+            return True
+
+        self.workers[pid] = task_id
+        return False
+
+    def worker_exited(self, pid, status):
+        """Replaces a worker that has exited, if it should be. Returns True
+        in the replacement worker process."""
+        task_id = self.workers.pop(pid, None)
+        if task_id is None:
+            return False
+
+        exit_code = os.WEXITSTATUS(status) if os.WIFEXITED(status) else None
+        restarted = pid == self.restarting
+        if restarted:
+            self.restarting = None
+
+        if self.stopping or (exit_code == 0 and not restarted):
+            return False
+
+        if not restarted and exit_code != RESTART_EXIT_CODE:
+            app_log.warning('Worker %d (pid %d) exited with status %d.',
+                            task_id, pid, status)
+            self.crashes += 1
+            if self.crashes > self.max_restarts:
+                raise RuntimeError('Too many worker restarts, giving up.')
+
+        if self.start_worker(task_id):
+            return True
+
+        self.restart_next()
+        return False
+
+    def handle_signal(self, signum, frame):
+        self.signals.append(signum)
+
+    def handle_signals(self):
+        """Acts on the signals received since this was last called."""
+        while self.signals:
+            signum = self.signals.pop(0)
+            if signum == signal.SIGTERM:
+                self.stopping = True
+                self.restart_queue = []
+                self.signal_workers(signum)
+            elif signum == signal.SIGUSR1:
+                self.reload(only_changed=False)
+            elif signum == signal.SIGHUP:
+                self.restart_all()
+
+    def reload(self, only_changed):
+        """Reloads the models, or only those that have changed, and
+        restarts the workers if any were reloaded. Failures are logged, and
+        the workers keep their current models."""
+        if self.reload_models is None or self.stopping:
+            return
+
+        try:
+            reloaded = self.reload_models(only_changed)
+        except Exception as e:
+            app_log.error('Failed to reload models: %s', e)
+            return
+
+        if reloaded:
+            gc.collect()
+            self.restart_all()
+
+    def restart_all(self):
+        """Restarts every worker, one at a time."""
+        if self.stopping:
+            return
+
+        self.restart_queue = list(self.workers)
+        if self.restarting is None:
+            self.restart_next()
+
+    def restart_next(self):
+        """Restarts the next worker waiting to be restarted, if there's one
+        and no other worker is restarting."""
+        if self.restarting is not None or self.stopping:
+            return
+
+        while self.restart_queue:
+            pid = self.restart_queue.pop(0)
+            if pid in self.workers:
+                self.restarting = pid
+                os.kill(pid, signal.SIGHUP)
+                return
+
+    def signal_workers(self, signum):
+        """Sends a signal to every worker."""
+        for pid in self.workers:
+            try:
+                os.kill(pid, signum)
+            except OSError as e:
+                if e.errno != errno.ESRCH:
+                    raise
+
+
+class Worker(object):
+    """Serves requests on a set of sockets, shutting down gracefully on
+    SIGTERM by waiting for in-flight requests to finish. Models are
+    reloaded on SIGUSR1, and frequently read cached results are refreshed
+    before they expire.
+
+    Workers of a Supervisor (`supervised`) also shut down gracefully on
+    SIGHUP, to be replaced, and leave watching the models' files to the
+    Supervisor. A server running in a single process has nothing to
+    restart it, so it watches the models' files itself and ignores
+    SIGHUP."""
+    def __init__(self, sockets, supervised=False):
+        self.server = HTTPServer(app)
+        self.server.add_sockets(sockets)
+        self.io_loop = IOLoop.current()
+        self.exit_code = None
+        self.supervised = supervised
+
+    def run(self):
+        """Serves requests until shut down, returning the exit code."""
+        signal.signal(signal.SIGTERM, self.handle_signal)
+        signal.signal(signal.SIGUSR1, self.handle_reload_signal)
+        if self.supervised:
+            signal.signal(signal.SIGHUP, self.handle_signal)
+        else:
+            signal.signal(signal.SIGHUP, self.handle_ignored_signal)
+
+        if not self.supervised and config.model_watch_interval:
+            PeriodicCallback(self.watch_models,
+                             config.model_watch_interval * 1000).start()
+
+        if config.cache_refresh_interval:
+            PeriodicCallback(self.refresh_hot_keys,
+                             config.cache_refresh_interval * 1000).start()
+
+        self.io_loop.start()
+        return self.exit_code
+
+    def handle_signal(self, signum, frame):
+        exit_code = RESTART_EXIT_CODE if signum == signal.SIGHUP else 0
+        self.io_loop.add_callback_from_signal(self.shutdown, exit_code)
+
+    def handle_ignored_signal(self, signum, frame):
+        self.io_loop.add_callback_from_signal(
+            app_log.warning, 'Ignoring SIGHUP: graceful restarts need '
+                             'server_processes other than 1.')
+
+    def handle_reload_signal(self, signum, frame):
+        self.io_loop.add_callback_from_signal(self.reload_models, False)
+
+    def watch_models(self):
+        self.reload_models(only_changed=True)
+
+    def reload_models(self, only_changed):
+        """Reloads models in the background, logging any failure. Networks
+        whose models fail to load keep using their current ones."""
+        future = executor.submit(reload_models, only_changed)
+        future.add_done_callback(log_reload_failure)
+
+    def refresh_hot_keys(self):
+        """Starts refreshing the most frequently read cached results that
+        are about to expire, logging any failure."""
+        future = executor.submit(refresh_hot_keys, config.cache_refresh_keys,
+                                 config.cache_refresh_ahead)
+        future.add_done_callback(log_refresh_failure)
+
+    @gen.coroutine
+    def shutdown(self, exit_code):
+        """Stops accepting connections, and stops the IOLoop once in-flight
+        requests finish or config.shutdown_timeout seconds pass."""
+        if self.exit_code is not None:
+            return
+
+        self.exit_code = exit_code
+        self.server.stop()
+
+        deadline = time.time() + config.shutdown_timeout
+        while BaseHandler.active_requests and time.time() < deadline:
+            yield gen.sleep(0.1)
+
+        self.io_loop.stop()
+
+
+def log_reload_failure(future):
+    """Logs the exception raised by a background model reload, if any."""
+    if future.exception() is not None:
+        app_log.error('Failed to reload models: %s', future.exception())
+
+
+def log_refresh_failure(future):
+    """Logs the exception raised when refreshing cached results, if any."""
+    if future.exception() is not None:
+        app_log.error('Failed to refresh cached results: %s',
+                      future.exception())
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=config.server_port)
+    parser.add_argument('--processes', type=int,
+                        default=config.server_processes,
+                        help='Number of worker processes to fork. '
+                             '0 forks one per CPU, and 1 does not fork.')
+    args = parser.parse_args()
+
+    sockets = bind_sockets(args.port)
+
+    # Everything is loaded before forking, so that workers share the
+    # classifiers and language models copy-on-write.
+    preload()
+    prepare_caches()
+
+    supervised = args.processes != 1
+    if supervised:
+        gc.collect()
+        supervisor = Supervisor(args.processes, config.server_max_restarts,
+                                reload_models, config.model_watch_interval)
+        if supervisor.run() is None:
+            sys.exit(0)
+
+    worker = Worker(sockets, supervised)
+    sys.exit(worker.run())
 
-from corpsearch import app
 
 if __name__ == '__main__':
-    app.listen(2020)
-    tornado.ioloop.IOLoop.current().start()
+    main()
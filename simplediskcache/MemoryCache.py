@@ -0,0 +1,98 @@
+from collections import OrderedDict
+from time import time
+import threading
+
+
+class MemoryCache(object):
+    """A bounded, thread-safe, in-memory cache. Entries expire `ttl` seconds
+    after being set (never, if `ttl` is None), and once `max_size` entries
+    are stored, the next one set evicts an entry according to `policy`:
+
+        'lru': the least recently read or written entry is evicted.
+
+        'fifo': the least recently written entry is evicted."""
+    POLICIES = ('lru', 'fifo')
+
+    def __init__(self, max_size=1024, ttl=None, policy='lru'):
+        if policy not in MemoryCache.POLICIES:
+            raise ValueError('Unknown eviction policy: ' + str(policy))
+
+        self.max_size = max_size
+        self.ttl = ttl
+        self.policy = policy
+
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def lookup(self, key):
+        """Returns a (found, value) pair for the given key. value is None
+        if the key wasn't found or has expired."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return False, None
+
+            expires, value = entry
+            if expires is not None and expires <= time():
+                del self.entries[key]
+                self.misses += 1
+                return False, None
+
+            if self.policy == 'lru':
+                del self.entries[key]
+                self.entries[key] = entry
+
+            self.hits += 1
+            return True, value
+
+    def get(self, key, default=None):
+        """Returns the value for the given key, or `default` if it isn't
+        cached."""
+        found, value = self.lookup(key)
+        return value if found else default
+
+    def set(self, key, value):
+        """Stores a value for the given key, evicting entries if the cache
+        is full."""
+        expires = time() + self.ttl if self.ttl is not None else None
+
+        with self.lock:
+            if key in self.entries:
+                del self.entries[key]
+
+            while self.entries and len(self.entries) >= self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+            if self.max_size > 0:
+                self.entries[key] = (expires, value)
+
+    def delete(self, key):
+        """Removes the given key from the cache, if present."""
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        """Removes all entries from the cache."""
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        """Returns a dictionary with the cache's size and hit, miss, and
+        eviction counts."""
+        with self.lock:
+            return {
+                'size': len(self.entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+
+    def __len__(self):
+        return len(self.entries)
@@ -1,84 +1,566 @@
+from concurrent.futures import ThreadPoolExecutor
 from time import time
-import shelve
 import os
-import os.path
 import functools
+import logging
+import threading
 
-from pymongo import DESCENDING
+from simplediskcache.MemoryCache import MemoryCache
+from simplediskcache.backends import open_backend
+from simplediskcache.keys import cache_key, legacy_cache_key
+from lazyconfig import config
+import metrics
 
-import mongo
+logger = logging.getLogger(__name__)
 
-def cache(filename):
-    """Decorator that implements a file-based cache for the given method."""
+# States of a result in an expiring_cache: results are fresh until they
+# expire, then stale for the cache's grace period, and then expired.
+FRESH = 'fresh'
+STALE = 'stale'
+EXPIRED = 'expired'
+
+# The most keys each expiring_cache counts reads of between calls to
+# refresh_hot_keys.
+MAX_TRACKED_KEYS = 10000
+
+# Functions that refresh each expiring_cache's most read keys.
+hot_key_refreshers = []
+
+# Functions that return each expiring_cache's backend, prepared for use.
+cache_backends = []
+
+# In-process caches in front of expiring_caches' backends, keyed by
+# cache name; see memory_cache_for.
+memory_caches = {}
+_memory_caches_lock = threading.Lock()
+
+# When each cache created before keys were hashed started migrating its
+# entries, keyed by cache name; see legacy_keys_since.
+_legacy_keys_since = {}
+
+
+def cache(filename, key_func=None, legacy_keys=False):
+    """Decorator that implements a file-based cache for the given method.
+    Results never expire. They're stored in an SQLite database, which can
+    be used by several processes at once, unless config.file_cache_backend
+    selects another backend.
+
+    Results are keyed by a hash of the function's arguments, leaving out
+    credentials; `key_func` can normalize the arguments first. See
+    keys.cache_key. Caches created before keys were hashed pass
+    `legacy_keys`; see migrating_legacy_keys.
+
+    The decorated function also has these attributes:
+
+        `lookup_many(calls)`: given a list of argument tuples, returns a
+        list with a (found, value) pair for the result of calling the
+        function with each, without calling it. Uses a single lookup where
+        the backend supports it.
+
+        `size()`: returns the number of results cached."""
     def wrapper(func):
+        def backend():
+            return configured_backend('file_cache_backend', filename)
+
+        def key_for(args, kwargs):
+            return cache_key(func, args, kwargs, key_func)
+
         @functools.wraps(func)
         def cacher(*args, **kwargs):
-            ensure_cache_dir_exists()
+            key = key_for(args, kwargs)
 
-            path = os.path.join('cache', filename)
-            store = shelve.open(path)
+            saved = backend().get(key)
+            if saved is None and legacy_keys and migrating_legacy_keys(filename):
+                saved = migrate_legacy_entry(backend(), key, args, kwargs)
 
-            key = str(args) + str(kwargs)
+            if saved is not None:
+                metrics.cache_requests.inc(cache=filename, result='hit')
+                return saved['value']
 
-            if key in store:
-                return store[key]['value']
+            metrics.cache_requests.inc(cache=filename, result='miss')
 
-            now = time()
+            value = func(*args, **kwargs)
+            backend().set(key, value, time())
+            return value
 
-            store[key] = {
-                'time': now,
-                'value': func(*args, **kwargs)
-            }
+        def lookup_many(calls):
+            keys = [key_for(args, {}) for args in calls]
+            saved = backend().get_many(keys)
 
-            value = store[key]['value']
-            store.close()
+            missing = [(key, args) for key, args in zip(keys, calls)
+                       if key not in saved]
+            if missing and legacy_keys and migrating_legacy_keys(filename):
+                saved.update(migrate_legacy_entries(backend(), missing))
 
-            return value
+            # Misses are counted if the function is then called for them.
+            results = []
+            for key in keys:
+                if key in saved:
+                    metrics.cache_requests.inc(cache=filename, result='hit')
+                    results.append((True, saved[key]['value']))
+                else:
+                    results.append((False, None))
+
+            return results
+
+        def size():
+            return backend().size()
 
+        cacher.lookup_many = lookup_many
+        cacher.size = size
         return cacher
 
     return wrapper
 
 
-def expiring_cache(filename, time_in_seconds):
-    """Decorator that implements a MongoDB-based expiring cache
-    for the given function. If the result stored in the DB is >
-    time_in_seconds old, the function is invoked, and the result
-    stored and returned."""
+def expiring_cache(filename, time_in_seconds, refresh=None, grace=None,
+                   key_func=None, legacy_keys=False):
+    """Decorator that implements an expiring cache for the given
+    function. If the stored result is > time_in_seconds old, the function
+    is invoked, and the result stored and returned. Results are stored in
+    MongoDB unless config.cache_backend selects another backend.
+
+    If `grace` is given, results up to `grace` seconds past expiry are
+    still returned straight away, while being refreshed in the background.
+    Results that are read often can also be refreshed before they expire;
+    see refresh_hot_keys.
+
+    If `refresh` is given, it's called instead of the function to replace
+    an expired result, with that result followed by the function's
+    arguments, so that it can update the result rather than retrieving
+    it again. Results are updated in place, and results that haven't
+    changed only have their time updated.
+
+    Results are keyed by a hash of the function's arguments, leaving out
+    credentials; `key_func` can normalize the arguments first, e.g.
+    `key_func=normalized('query')` to share results between queries that
+    differ only in case and whitespace. See keys.cache_key. Caches created
+    before keys were hashed pass `legacy_keys`; see migrating_legacy_keys.
+
+    Each key has a single stored entry, which the backend deletes once it
+    has expired and is past the grace period. Caches configured in
+    config.memory_caches also keep recently used entries in memory, in
+    front of the backend; see memory_cache_for.
+
+    The decorated function also has these attributes, for callers that
+    retrieve results some other way (e.g. in bulk):
+
+        `lookup(*args, **kwargs)`: returns a (found, value) pair for the
+        result of calling the function with the given arguments, without
+        calling it. Expired results aren't found.
+
+        `lookup_stale(*args, **kwargs)`: returns a (found, value, state)
+        triple, finding stale and expired results too. `state` is one of
+        FRESH, STALE, or EXPIRED.
+
+        `lookup_many(calls)` and `lookup_stale_many(calls)`: given a list
+        of argument tuples, return a list with the result of `lookup` or
+        `lookup_stale` for each, using a single backend lookup for results
+        that aren't in memory.
+
+        `store(value, *args, **kwargs)`: stores `value` as the result of
+        calling the function with the given arguments."""
+    # How long entries are kept for, after which they can't be used.
+    lifetime = time_in_seconds + (grace or 0)
+
     def wrapper(func):
+        def backend():
+            return configured_backend('cache_backend', filename, lifetime)
+
+        cache_backends.append(backend)
+
+        def latest_entry(key):
+            """Returns the saved entry for key, or None, from memory if
+            it's there."""
+            memory = memory_cache_for(filename)
+            if memory is None:
+                return stored_entry(key)
+
+            found, saved = memory.lookup(key)
+            if not found:
+                saved = stored_entry(key)
+                if saved is not None:
+                    memory.set(key, saved)
+
+            return saved
+
+        def latest_entries(keys):
+            """Returns the saved entries for keys, keyed by key, taking
+            those in memory from there and the rest from the backend in a
+            single lookup."""
+            memory = memory_cache_for(filename)
+            entries = {}
+            if memory is not None:
+                for key in keys:
+                    found, saved = memory.lookup(key)
+                    if found:
+                        entries[key] = saved
+
+            missing = [x for x in keys if x not in entries]
+            if missing:
+                stored = backend().get_many(missing)
+                if memory is not None:
+                    for key, saved in stored.iteritems():
+                        memory.set(key, saved)
+
+                entries.update(stored)
+
+            return entries
+
+        def find_entry(key, args, kwargs):
+            """Returns the latest entry for key, or None, moving an entry
+            saved under the call's legacy key to key if there's one."""
+            saved = latest_entry(key)
+            if saved is None:
+                saved = migrated_entry(key, args, kwargs)
+
+            return saved
+
+        def migrated_entry(key, args, kwargs):
+            """Moves the entry saved under the call's legacy key to key, if
+            there's one and this cache still migrates them. Returns the
+            entry, or None."""
+            if not legacy_keys or not migrating_legacy_keys(filename, lifetime):
+                return None
+
+            saved = migrate_legacy_entry(backend(), key, args, kwargs,
+                                         lifetime)
+            memory = memory_cache_for(filename)
+            if saved is not None and memory is not None:
+                memory.set(key, saved)
+
+            return saved
+
+        def stored_entry(key):
+            """Returns the entry for key saved in the backend, or None."""
+            return backend().get(key)
+
+        def save(key, value, saved):
+            """Saves value for key, replacing the saved entry if there is
+            one, or only updating its time if the value hasn't changed."""
+            now = time()
+            if saved is None or value != saved['value']:
+                backend().set(key, value, now, lifetime)
+            else:
+                backend().touch(key, now, lifetime)
+
+            memory = memory_cache_for(filename)
+            if memory is not None:
+                memory.set(key, {'key': key, 'time': now, 'value': value})
+
+        def state_of(saved):
+            """Returns whether a saved entry is fresh, stale, or expired."""
+            age = time() - saved['time']
+            if age <= time_in_seconds:
+                return FRESH
+            if grace is not None and age <= time_in_seconds + grace:
+                return STALE
+
+            return EXPIRED
+
+        def update(key, args, kwargs, saved):
+            """Retrieves a new value for key, refreshing the saved entry if
+            there is one, and saves it."""
+            if saved is not None and refresh is not None:
+                value = refresh(saved['value'], *args, **kwargs)
+            else:
+                value = func(*args, **kwargs)
+
+            save(key, value, saved)
+            return value
+
+        def revalidate(key, args, kwargs, saved_at):
+            """Updates the entry for key in the background, unless it has
+            been saved since `saved_at` (e.g. by another process). Reads
+            the backend rather than memory, to see other processes'
+            updates."""
+            saved = stored_entry(key)
+            if saved is not None and saved['time'] > saved_at:
+                return
+
+            update(key, args, kwargs, saved)
+
+        # Reads of each key since the last call to refresh_hottest, with
+        # the arguments to refresh it with.
+        reads = {}
+        reads_lock = threading.Lock()
+
+        def count_read(key, args, kwargs):
+            with reads_lock:
+                if key in reads:
+                    reads[key][0] += 1
+                elif len(reads) < MAX_TRACKED_KEYS:
+                    reads[key] = [1, args, kwargs]
+
+        def refresh_hottest(limit, ahead):
+            """Refreshes the `limit` most read keys since the last call in
+            the background, if they expire within `ahead` seconds. Returns
+            the number of keys refreshed."""
+            with reads_lock:
+                hottest = sorted(reads.iteritems(), key=lambda x: x[1][0],
+                                 reverse=True)[:limit]
+                reads.clear()
+
+            refreshed = 0
+            for key, (_, args, kwargs) in hottest:
+                saved = latest_entry(key)
+                if saved is None:
+                    continue
+
+                expiring = time() - saved['time'] > time_in_seconds - ahead
+                if expiring and refresh_in_background(filename, key,
+                                                      revalidate, key, args,
+                                                      kwargs, saved['time']):
+                    refreshed += 1
+
+            return refreshed
+
+        hot_key_refreshers.append(refresh_hottest)
+
+        def key_for(args, kwargs):
+            return cache_key(func, args, kwargs, key_func)
+
         @functools.wraps(func)
         def cacher(*args, **kwargs):
-            now = time()
+            key = key_for(args, kwargs)
+            count_read(key, args, kwargs)
 
-            client = mongo.client
-            db = client.cache[filename]
-            key = str(args) + str(kwargs)
+            saved = find_entry(key, args, kwargs)
+            if saved is not None:
+                state = state_of(saved)
+                if state == FRESH:
+                    metrics.cache_requests.inc(cache=filename, result='hit')
+                    return saved['value']
 
-            latest = db.find({'key': key}).sort("time", DESCENDING)
-            if latest.count():
-                saved = latest[0]
-                value_has_expired = now - saved['time'] > time_in_seconds
-                if not value_has_expired:
+                metrics.cache_requests.inc(cache=filename, result=state)
+                if state == STALE:
+                    refresh_in_background(filename, key, revalidate,
+                                          key, args, kwargs, saved['time'])
                     return saved['value']
+            else:
+                metrics.cache_requests.inc(cache=filename, result='miss')
+
+            return update(key, args, kwargs, saved)
+
+        def lookup(*args, **kwargs):
+            found, value, state = lookup_stale(*args, **kwargs)
+            if found and state == FRESH:
+                return True, value
+
+            return False, None
+
+        def lookup_stale(*args, **kwargs):
+            saved = find_entry(key_for(args, kwargs), args, kwargs)
+            if saved is None:
+                return False, None, EXPIRED
+
+            return True, saved['value'], state_of(saved)
 
-            entry = {
-                'time': now,
-                'key': key,
-                'value': func(*args, **kwargs)
-            }
+        def lookup_many(calls):
+            results = []
+            for found, value, state in lookup_stale_many(calls):
+                if found and state == FRESH:
+                    results.append((True, value))
+                else:
+                    results.append((False, None))
 
-            db.insert(entry)
-            return entry['value']
+            return results
 
+        def lookup_stale_many(calls):
+            keys = [key_for(args, {}) for args in calls]
+            entries = latest_entries(keys)
+
+            results = []
+            for key, args in zip(keys, calls):
+                saved = entries.get(key)
+                if saved is None:
+                    saved = migrated_entry(key, args, {})
+
+                if saved is None:
+                    results.append((False, None, EXPIRED))
+                else:
+                    results.append((True, saved['value'], state_of(saved)))
+
+            return results
+
+        def store(value, *args, **kwargs):
+            key = key_for(args, kwargs)
+            save(key, value, latest_entry(key))
+
+        cacher.lookup = lookup
+        cacher.lookup_stale = lookup_stale
+        cacher.lookup_many = lookup_many
+        cacher.lookup_stale_many = lookup_stale_many
+        cacher.store = store
         return cacher
 
     return wrapper
 
 
-def ensure_cache_dir_exists():
-    """Creates the cache directory if it does not already exist."""
-    if not os.path.exists('cache'):
-        os.mkdir('cache')
+def memory_cache_for(filename):
+    """Returns the MemoryCache in front of the backend of the
+    expiring_cache called `filename`, or None if it doesn't have one.
+    Caches are configured in config.memory_caches, as MemoryCache arguments
+    keyed by cache name. Their `ttl` bounds how long entries refreshed by
+    other processes can be out of date for."""
+    if filename in memory_caches:
+        return memory_caches[filename]
+
+    with _memory_caches_lock:
+        if filename not in memory_caches:
+            settings = config.memory_caches.get(filename)
+            if settings is not None:
+                memory_caches[filename] = MemoryCache(**settings)
+            else:
+                memory_caches[filename] = None
+
+        return memory_caches[filename]
+
+
+metrics.memory_cache_entries.set_function(lambda: {
+    (name,): len(memory)
+    for name, memory in memory_caches.items() if memory is not None
+})
+
+
+def configured_backend(setting, name, lifetime=None):
+    """Returns the backend for the cache called `name`, of the kind given
+    by the config setting called `setting`."""
+    return open_backend(getattr(config, setting), name, lifetime)
+
+
+def prepare_caches():
+    """Prepares every expiring_cache's backend (e.g. creating MongoDB
+    indexes). Caches also do this when they're first used, but doing it
+    at startup keeps it from delaying the first requests."""
+    for backend in cache_backends:
+        backend()
+
+
+def refresh_hot_keys(limit, ahead):
+    """Refreshes the `limit` most read keys of each expiring_cache since
+    the last call in the background, if they expire within `ahead` seconds,
+    so that they're never read after expiring. Returns the number of keys
+    refreshed."""
+    return sum(refresher(limit, ahead) for refresher in hot_key_refreshers)
+
+
+_refresh_pool = None
+_refresh_pool_pid = None
+_refreshing = set()
+_refresh_lock = threading.Lock()
+_background = threading.local()
+
+
+def refresh_in_background(cache_name, key, refresher, *args):
+    """Calls refresher(*args) on the background refresh pool to refresh a
+    cache's key, unless that key is already being refreshed. Returns
+    whether the refresh was started."""
+    global _refresh_pool, _refresh_pool_pid, _refreshing
+
+    with _refresh_lock:
+        # Forked processes don't inherit the pool's threads, so they get
+        # their own pool.
+        if _refresh_pool is None or _refresh_pool_pid != os.getpid():
+            _refresh_pool = ThreadPoolExecutor(config.cache_refresh_workers)
+            _refresh_pool_pid = os.getpid()
+            _refreshing = set()
+
+        if (cache_name, key) in _refreshing:
+            return False
+
+        _refreshing.add((cache_name, key))
+        _refresh_pool.submit(run_refresh, cache_name, key, refresher, *args)
+        return True
+
+
+def run_refresh(cache_name, key, refresher, *args):
+    """Runs a background refresh, counting and logging failures."""
+    _background.active = True
+    try:
+        refresher(*args)
+        metrics.cache_refreshes.inc(cache=cache_name, result='ok')
+    except Exception:
+        metrics.cache_refreshes.inc(cache=cache_name, result='error')
+        logger.exception('Failed to refresh %s in the %s cache.', key,
+                         cache_name)
+    finally:
+        _background.active = False
+        with _refresh_lock:
+            _refreshing.discard((cache_name, key))
+
+
+def in_background_refresh():
+    """Returns whether this thread is refreshing a cached result in the
+    background, rather than for a caller waiting on it."""
+    return getattr(_background, 'active', False)
+
+
+def migrating_legacy_keys(cache_name, lifetime=None):
+    """Returns whether a cache created before keys were hashed still looks
+    for a result under its legacy key when it isn't found under its hashed
+    one. Caches whose entries expire after `lifetime` seconds do so for
+    that long after they started migrating (see legacy_keys_since), by
+    which time every legacy entry has expired. Caches whose entries never
+    expire do so for config.legacy_cache_keys_period seconds, after which
+    results that weren't migrated are retrieved again."""
+    if lifetime is None:
+        lifetime = config.legacy_cache_keys_period
+
+    return time() < legacy_keys_since(cache_name) + lifetime
+
+
+def legacy_keys_since(cache_name):
+    """Returns when the cache called `cache_name` started migrating
+    entries saved under legacy keys, recording the current time if it
+    hasn't yet. Start times are saved in the 'cache_metadata' cache, whose
+    entries never expire, so that they're kept across restarts and shared
+    by the processes using it."""
+    if cache_name in _legacy_keys_since:
+        return _legacy_keys_since[cache_name]
+
+    backend = configured_backend('file_cache_backend', 'cache_metadata')
+    key = 'legacy_keys_since:' + cache_name
+    saved = backend.get(key)
+    if saved is None:
+        now = time()
+        backend.set(key, now, now)
+        saved = {'value': now}
+
+    _legacy_keys_since[cache_name] = saved['value']
+    return saved['value']
+
+
+def migrate_legacy_entry(backend, key, args, kwargs, lifetime=None):
+    """Moves the entry for a call saved under its legacy, unhashed key (see
+    keys.legacy_cache_key) to `key`, so that results cached before keys
+    were hashed can still be used. Returns the entry, or None if there
+    isn't one. The legacy entry is left for the backend to expire.
+    `lifetime` is the lifetime of the backend's entries, if they expire."""
+    saved = backend.get(legacy_cache_key(args, kwargs))
+    if saved is None:
+        return None
+
+    backend.set(key, saved['value'], saved['time'], lifetime)
+    saved['key'] = key
+    return saved
+
+
+def migrate_legacy_entries(backend, calls):
+    """Like migrate_legacy_entry, for a list of (key, args) pairs, using a
+    single lookup, for caches whose entries don't expire. Returns the
+    entries moved, keyed by their new keys."""
+    legacy_keys = dict((legacy_cache_key(args, {}), key)
+                       for key, args in calls)
+
+    migrated = {}
+    for legacy_key, saved in backend.get_many(legacy_keys.keys()).iteritems():
+        key = legacy_keys[legacy_key]
+        backend.set(key, saved['value'], saved['time'])
+        saved['key'] = key
+        migrated[key] = saved
+
+    return migrated
 
 
 @expiring_cache('fibonacci', 600)
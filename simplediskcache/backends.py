@@ -0,0 +1,436 @@
+from datetime import datetime
+from time import time
+import abc
+import cPickle
+import os
+import os.path
+import shelve
+import sqlite3
+import threading
+import whichdb
+
+# Directory that file-based backends keep their files in.
+CACHE_DIRECTORY = 'cache'
+
+
+class Backend(object):
+    """Stores a cache's entries. An entry is a dictionary with the `key`,
+    the `time` it was saved at, and its `value`. Entries saved with a
+    `lifetime` (in seconds) are deleted some time after it passes; those
+    saved without one are kept.
+
+    Backends are used from several threads at once, and may also be used
+    from several processes."""
+    __metaclass__ = abc.ABCMeta
+
+    def __init__(self, name):
+        self.name = name
+
+    def prepare(self):
+        """Creates whatever the backend needs to store entries, such as
+        tables or indexes. Called before the backend is first used in each
+        process."""
+        pass
+
+    @abc.abstractmethod
+    def get(self, key):
+        """Returns the entry saved for key, or None."""
+
+    def get_many(self, keys):
+        """Returns a dictionary of the entries saved for any of the given
+        keys, keyed by key."""
+        entries = {}
+        for key in keys:
+            entry = self.get(key)
+            if entry is not None:
+                entries[key] = entry
+
+        return entries
+
+    @abc.abstractmethod
+    def set(self, key, value, saved_at, lifetime=None):
+        """Saves an entry for key, replacing any saved before."""
+
+    @abc.abstractmethod
+    def touch(self, key, saved_at, lifetime=None):
+        """Updates the time an existing entry was saved at, without
+        changing its value."""
+
+    @abc.abstractmethod
+    def clear(self):
+        """Deletes every entry."""
+
+    @abc.abstractmethod
+    def size(self):
+        """Returns the number of entries saved."""
+
+
+class MongoBackend(Backend):
+    """Stores entries in a collection in MongoDB's `cache` database, with
+    a unique index on `key`. MongoDB deletes entries once their lifetime
+    has passed, using a TTL index on `expires_at`."""
+    def __init__(self, name, lifetime=None):
+        super(MongoBackend, self).__init__(name)
+        self.lifetime = lifetime
+
+    @property
+    def collection(self):
+        # Imported here, as importing mongo connects to the server.
+        import mongo
+        return mongo.client.cache[self.name]
+
+    def prepare(self):
+        """Creates the indexes. Collections written by earlier versions,
+        which inserted a new entry on each refresh and didn't set
+        `expires_at`, are cleaned up first if needed."""
+        from pymongo.errors import OperationFailure
+
+        collection = self.collection
+        try:
+            collection.create_index('key', unique=True)
+        except OperationFailure:
+            remove_duplicate_entries(collection)
+            collection.create_index('key', unique=True)
+
+        collection.create_index('expires_at', expireAfterSeconds=0)
+
+        if self.lifetime is not None:
+            for entry in collection.find({'expires_at': {'$exists': False}},
+                                         {'time': True}):
+                collection.update({'_id': entry['_id']}, {'$set': {
+                    'expires_at': expiry_date(entry['time'], self.lifetime)
+                }})
+
+    def get(self, key):
+        return self.collection.find_one({'key': key})
+
+    def get_many(self, keys):
+        return {x['key']: x
+                for x in self.collection.find({'key': {'$in': list(keys)}})}
+
+    def set(self, key, value, saved_at, lifetime=None):
+        self.update(key, {'value': value}, saved_at, lifetime, upsert=True)
+
+    def touch(self, key, saved_at, lifetime=None):
+        self.update(key, {}, saved_at, lifetime, upsert=False)
+
+    def update(self, key, fields, saved_at, lifetime, upsert):
+        fields = dict(fields, time=saved_at)
+        unset = {}
+        if lifetime is not None:
+            fields['expires_at'] = expiry_date(saved_at, lifetime)
+        else:
+            unset['expires_at'] = True
+
+        change = {'$set': fields}
+        if unset:
+            change['$unset'] = unset
+
+        self.collection.update({'key': key}, change, upsert=upsert)
+
+    def clear(self):
+        self.collection.remove({})
+
+    def size(self):
+        return self.collection.count()
+
+
+def expiry_date(saved_at, lifetime):
+    """Returns the date an entry saved at `saved_at` expires, for MongoDB's
+    TTL index."""
+    return datetime.utcfromtimestamp(saved_at + lifetime)
+
+
+def remove_duplicate_entries(collection):
+    """Removes all but the latest entry for each key in a collection."""
+    latest = {}
+    for entry in collection.find({}, {'key': True, 'time': True}):
+        kept = latest.get(entry['key'])
+        if kept is None:
+            latest[entry['key']] = entry
+            continue
+
+        older, newer = sorted([kept, entry], key=lambda x: x['time'])
+        collection.remove({'_id': older['_id']})
+        latest[entry['key']] = newer
+
+
+class SQLiteBackend(Backend):
+    """Stores entries in an embedded SQLite database, in a file in
+    CACHE_DIRECTORY, so that no server is needed. Values are pickled.
+    Expired entries aren't returned, and are deleted when the backend is
+    prepared.
+
+    Connections are opened once and kept open, one per thread of each
+    process, as SQLite connections can't be shared between threads or
+    across forks. With write-ahead logging, any number of threads and
+    processes can read while one writes. Writes are serialized: between a
+    process's threads by a lock, and between processes by SQLite, which
+    waits up to `timeout` seconds for another process's write to finish.
+
+    When the database is created, entries are imported from the shelve
+    file ShelveBackend keeps for the same cache, if there is one."""
+    # The most keys looked up in one query, below SQLite's limit on the
+    # number of parameters.
+    MAX_KEYS_PER_QUERY = 500
+
+    def __init__(self, name, directory=CACHE_DIRECTORY, timeout=30):
+        super(SQLiteBackend, self).__init__(name)
+        self.directory = directory
+        self.path = os.path.join(directory, name + '.sqlite')
+        self.timeout = timeout
+        self.local = threading.local()
+        self.write_lock = threading.Lock()
+
+    @property
+    def connection(self):
+        # Connections aren't carried across forks, or between threads.
+        if getattr(self.local, 'pid', None) != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=self.timeout)
+            connection.execute('PRAGMA journal_mode=WAL')
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+
+        return self.local.connection
+
+    def prepare(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        with self.write_lock, self.connection as connection:
+            created = not connection.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' "
+                "AND name = 'entries'").fetchone()
+
+            connection.execute('CREATE TABLE IF NOT EXISTS entries ('
+                               'key TEXT PRIMARY KEY, '
+                               'time REAL NOT NULL, '
+                               'expires_at REAL, '
+                               'value BLOB NOT NULL)')
+            if created:
+                self.import_shelve(connection)
+
+            connection.execute('DELETE FROM entries WHERE expires_at <= ?',
+                               (time(),))
+
+    def import_shelve(self, connection):
+        """Copies the entries in this cache's shelve file, if it has one,
+        into the database."""
+        shelve_path = ShelveBackend(self.name, self.directory).path
+        if not whichdb.whichdb(shelve_path):
+            return
+
+        store = shelve.open(shelve_path, flag='r')
+        try:
+            connection.executemany('INSERT OR IGNORE INTO entries '
+                                   '(key, time, expires_at, value) '
+                                   'VALUES (?, ?, NULL, ?)',
+                                   ((key, saved['time'],
+                                     serialize(saved['value']))
+                                    for key, saved in store.iteritems()))
+        finally:
+            store.close()
+
+    def get(self, key):
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys):
+        keys = list(keys)
+        entries = {}
+        for start in xrange(0, len(keys), self.MAX_KEYS_PER_QUERY):
+            chunk = keys[start:start + self.MAX_KEYS_PER_QUERY]
+            rows = self.connection.execute(
+                'SELECT key, time, value FROM entries '
+                'WHERE key IN (%s) '
+                'AND (expires_at IS NULL OR expires_at > ?)' %
+                ', '.join('?' * len(chunk)), chunk + [time()])
+
+            for key, saved_at, data in rows:
+                entries[key] = {
+                    'key': key,
+                    'time': saved_at,
+                    'value': cPickle.loads(str(data))
+                }
+
+        return entries
+
+    def set(self, key, value, saved_at, lifetime=None):
+        data = serialize(value)
+        with self.write_lock, self.connection as connection:
+            connection.execute('INSERT OR REPLACE INTO entries '
+                               '(key, time, expires_at, value) '
+                               'VALUES (?, ?, ?, ?)',
+                               (key, saved_at,
+                                expiry_time(saved_at, lifetime), data))
+
+    def touch(self, key, saved_at, lifetime=None):
+        with self.write_lock, self.connection as connection:
+            connection.execute('UPDATE entries SET time = ?, expires_at = ? '
+                               'WHERE key = ?',
+                               (saved_at, expiry_time(saved_at, lifetime),
+                                key))
+
+    def clear(self):
+        with self.write_lock, self.connection as connection:
+            connection.execute('DELETE FROM entries')
+
+    def size(self):
+        return self.connection.execute(
+            'SELECT COUNT(*) FROM entries '
+            'WHERE expires_at IS NULL OR expires_at > ?',
+            (time(),)).fetchone()[0]
+
+
+def serialize(value):
+    """Returns a value pickled for storage in SQLite."""
+    return sqlite3.Binary(cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL))
+
+
+def expiry_time(saved_at, lifetime):
+    """Returns the time an entry saved at `saved_at` expires, or None if it
+    doesn't."""
+    return saved_at + lifetime if lifetime is not None else None
+
+
+class MemoryBackend(Backend):
+    """Stores entries in this process's memory, so that nothing is kept
+    between runs or shared between processes. Useful for tests and
+    one-off runs."""
+    def __init__(self, name):
+        super(MemoryBackend, self).__init__(name)
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+
+            expires_at, saved = entry
+            if expires_at is not None and expires_at <= time():
+                del self.entries[key]
+                return None
+
+            return saved
+
+    def set(self, key, value, saved_at, lifetime=None):
+        with self.lock:
+            self.entries[key] = (expiry_time(saved_at, lifetime), {
+                'key': key,
+                'time': saved_at,
+                'value': value
+            })
+
+    def touch(self, key, saved_at, lifetime=None):
+        with self.lock:
+            if key in self.entries:
+                saved = dict(self.entries[key][1], time=saved_at)
+                self.entries[key] = (expiry_time(saved_at, lifetime), saved)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def size(self):
+        with self.lock:
+            return len(self.entries)
+
+
+class ShelveBackend(Backend):
+    """Stores entries in a shelve file in CACHE_DIRECTORY, which is opened
+    for each operation. Entries are never deleted. Shelve files can't be
+    written by several processes at once, so SQLiteBackend should be used
+    instead where that can happen."""
+    def __init__(self, name, directory=CACHE_DIRECTORY):
+        super(ShelveBackend, self).__init__(name)
+        self.directory = directory
+        self.path = os.path.join(directory, name)
+
+    def prepare(self):
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+    def get(self, key):
+        store = shelve.open(self.path)
+        try:
+            if key not in store:
+                return None
+
+            saved = store[key]
+            return {'key': key, 'time': saved['time'], 'value': saved['value']}
+        finally:
+            store.close()
+
+    def set(self, key, value, saved_at, lifetime=None):
+        store = shelve.open(self.path)
+        try:
+            store[key] = {'time': saved_at, 'value': value}
+        finally:
+            store.close()
+
+    def touch(self, key, saved_at, lifetime=None):
+        store = shelve.open(self.path)
+        try:
+            if key in store:
+                store[key] = {'time': saved_at, 'value': store[key]['value']}
+        finally:
+            store.close()
+
+    def clear(self):
+        shelve.open(self.path, flag='n').close()
+
+    def get_many(self, keys):
+        store = shelve.open(self.path)
+        try:
+            return {key: {
+                'key': key,
+                'time': store[key]['time'],
+                'value': store[key]['value']
+            } for key in keys if key in store}
+        finally:
+            store.close()
+
+    def size(self):
+        store = shelve.open(self.path)
+        try:
+            return len(store)
+        finally:
+            store.close()
+
+
+backend_types = {
+    'mongo': MongoBackend,
+    'sqlite': SQLiteBackend,
+    'memory': MemoryBackend,
+    'shelve': ShelveBackend
+}
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+
+def open_backend(kind, name, lifetime=None):
+    """Returns the backend of the given kind (a key of backend_types) for
+    the cache called `name`, prepared for use in this process. Each cache
+    has one backend per process. `lifetime` is the longest lifetime the
+    cache's entries are saved with, if they expire."""
+    key = (kind, name, os.getpid())
+    if key in _backends:
+        return _backends[key]
+
+    with _backends_lock:
+        if key not in _backends:
+            if kind not in backend_types:
+                raise ValueError('Unknown cache backend: ' + str(kind))
+
+            if kind == 'mongo':
+                backend = MongoBackend(name, lifetime)
+            else:
+                backend = backend_types[kind](name)
+
+            backend.prepare()
+            _backends[key] = backend
+
+        return _backends[key]
@@ -0,0 +1,94 @@
+"""Measures the throughput and latency of each cache backend, to help
+choose one for a deployment. Run from the repository root:
+
+    python -m simplediskcache.benchmark --backends memory sqlite mongo
+
+Entries are written to, and then deleted from, a cache called
+`benchmark`."""
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+import argparse
+import random
+
+from simplediskcache.backends import open_backend, backend_types
+
+
+def sample_value(posts):
+    """Returns a value shaped like a cached timeline with `posts` posts."""
+    return [{
+        'id': 600000000000000000 + x,
+        'created_at': 'Mon Jun 01 12:00:00 +0000 2015',
+        'text': 'A sample post, with some text in it, #' + str(x),
+        'user': {'id': 12345, 'screen_name': 'sample'}
+    } for x in xrange(posts)]
+
+
+def timed_calls(function, arguments, threads):
+    """Calls `function` with each of `arguments` on `threads` threads.
+    Returns the total time taken, and each call's latency."""
+    def call(argument):
+        start = time()
+        function(argument)
+        return time() - start
+
+    start = time()
+    pool = ThreadPoolExecutor(threads)
+    latencies = list(pool.map(call, arguments))
+    pool.shutdown()
+
+    return time() - start, sorted(latencies)
+
+
+def percentile(latencies, fraction):
+    """Returns the latency that the given fraction of sorted latencies are
+    below."""
+    return latencies[min(len(latencies) - 1, int(len(latencies) * fraction))]
+
+
+def benchmark(kind, keys, reads, value, threads):
+    """Benchmarks writes of `keys` keys, then `reads` random reads of them,
+    on a backend. Returns a list of (operation, operations per second, p50
+    latency, p99 latency) tuples."""
+    backend = open_backend(kind, 'benchmark', 60*60)
+    backend.clear()
+
+    key_names = ['key %d' % x for x in xrange(keys)]
+    read_keys = [random.choice(key_names) for _ in xrange(reads)]
+
+    results = []
+    operations = [
+        ('set', lambda key: backend.set(key, value, time(), 60*60),
+         key_names),
+        ('get', backend.get, read_keys),
+        ('touch', lambda key: backend.touch(key, time(), 60*60), key_names)
+    ]
+    for name, function, arguments in operations:
+        elapsed, latencies = timed_calls(function, arguments, threads)
+        results.append((name, len(arguments) / elapsed,
+                        percentile(latencies, 0.5),
+                        percentile(latencies, 0.99)))
+
+    backend.clear()
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--backends', nargs='+', default=['memory', 'sqlite'],
+                        choices=sorted(backend_types))
+    parser.add_argument('--keys', type=int, default=1000)
+    parser.add_argument('--reads', type=int, default=10000)
+    parser.add_argument('--posts', type=int, default=20,
+                        help='size of each value, in posts')
+    parser.add_argument('--threads', type=int, default=4)
+    args = parser.parse_args()
+
+    value = sample_value(args.posts)
+
+    print '%-8s %-6s %12s %10s %10s' % ('backend', 'op', 'ops/s',
+                                        'p50 ms', 'p99 ms')
+    for kind in args.backends:
+        for name, rate, p50, p99 in benchmark(kind, args.keys, args.reads,
+                                              value, args.threads):
+            print '%-8s %-6s %12.0f %10.3f %10.3f' % (kind, name, rate,
+                                                      p50 * 1000, p99 * 1000)
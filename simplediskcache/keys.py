@@ -0,0 +1,67 @@
+import hashlib
+import inspect
+import json
+
+# Arguments that hold credentials, which are left out of cache keys: a
+# result doesn't depend on the credentials used to retrieve it, and keys
+# shouldn't reveal them.
+CREDENTIAL_ARGUMENTS = frozenset(['access_token', 'access_token_secret'])
+
+
+def cache_key(func, args, kwargs, key_func=None):
+    """Returns the key that a function's result is cached under, given the
+    arguments it was called with.
+
+    The arguments are bound to the function's parameter names, so that a
+    call gives the same key however its arguments are passed, and
+    credential arguments are left out. If `key_func` is given, it's called
+    with the bound arguments as a dictionary, and returns the value to key
+    the result by instead (see `normalized`). The key is a hash of that
+    value encoded as canonical JSON, so str and unicode strings, and ints
+    and longs, that are equal give the same key."""
+    arguments = inspect.getcallargs(func, *args, **kwargs)
+    for name in CREDENTIAL_ARGUMENTS:
+        arguments.pop(name, None)
+
+    if key_func is not None:
+        arguments = key_func(arguments)
+
+    encoded = json.dumps(arguments, sort_keys=True, separators=(',', ':'),
+                         default=repr)
+    return hashlib.sha1(encoded).hexdigest()
+
+
+def legacy_cache_key(args, kwargs):
+    """Returns the key that a function's result was cached under before
+    keys were hashed, so that those entries can be moved to their new
+    keys."""
+    return str(args) + str(kwargs)
+
+
+def normalize_text(text):
+    """Returns a normalized form of a string, ignoring case and repeated
+    whitespace. Byte strings are decoded as UTF-8 first, so that they
+    normalize the same as the equivalent unicode strings."""
+    if isinstance(text, str):
+        text = text.decode('utf-8')
+
+    return ' '.join(text.split()).lower()
+
+
+def normalized(*names):
+    """Returns a key function for cache_key that normalizes the named string
+    arguments with normalize_text, so that e.g. searches for "Apple" and
+    "apple " share a cached result.
+
+        @expiring_cache('search', 60*60*24, key_func=normalized('query'))
+        def search_twitter_ids(query):
+            ...
+    """
+    def key_func(arguments):
+        normalized_arguments = dict(arguments)
+        for name in names:
+            normalized_arguments[name] = normalize_text(arguments[name])
+
+        return normalized_arguments
+
+    return key_func
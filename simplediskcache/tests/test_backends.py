@@ -0,0 +1,67 @@
+from time import time
+
+import shelve
+
+import pytest
+
+from ..backends import Backend, MemoryBackend, SQLiteBackend, ShelveBackend
+
+
+def check_backend(backend):
+    """Checks that a backend saves, updates, expires, and clears entries."""
+    backend.prepare()
+    now = time()
+
+    backend.set('a', {'posts': [1, 2]}, now, 60)
+    assert backend.get('a') == {'key': 'a', 'time': now,
+                                'value': {'posts': [1, 2]}}
+    assert backend.get('b') is None
+
+    backend.touch('a', now + 1, 60)
+    assert backend.get('a')['time'] == now + 1
+    assert backend.get('a')['value'] == {'posts': [1, 2]}
+
+    backend.set('expired', 1, now - 120, 60)
+    assert backend.get('expired') is None
+
+    backend.set('kept', 1, now - 120)
+    assert backend.get('kept')['value'] == 1
+
+    entries = backend.get_many(['a', 'b', 'kept', 'expired'])
+    assert sorted(entries) == ['a', 'kept']
+    assert entries['a']['value'] == {'posts': [1, 2]}
+    assert backend.size() == 2
+
+    backend.clear()
+    assert backend.get('a') is None
+
+
+def test_memory_backend():
+    check_backend(MemoryBackend('test'))
+
+
+def test_sqlite_backend(tmpdir):
+    check_backend(SQLiteBackend('test', directory=str(tmpdir)))
+
+
+def test_sqlite_imports_shelve(tmpdir):
+    """Tests that a new SQLite database takes the entries in the cache's
+    shelve file."""
+    store = shelve.open(ShelveBackend('urls', str(tmpdir)).path)
+    store['url'] = {'time': 1.0, 'value': 'resolved'}
+    store.close()
+
+    backend = SQLiteBackend('urls', directory=str(tmpdir))
+    backend.prepare()
+
+    assert backend.get('url') == {'key': 'url', 'time': 1.0,
+                                  'value': 'resolved'}
+
+
+def test_incomplete_backend_cant_be_created():
+    class GetOnlyBackend(Backend):
+        def get(self, key):
+            return None
+
+    with pytest.raises(TypeError):
+        GetOnlyBackend('incomplete')
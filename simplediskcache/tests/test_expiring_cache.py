@@ -0,0 +1,174 @@
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+import os
+import threading
+
+import pytest
+
+from .. import SimpleDiskCache
+from ..SimpleDiskCache import cache, expiring_cache, in_background_refresh, \
+    FRESH
+from ..backends import open_backend
+from ..keys import legacy_cache_key
+
+
+@pytest.fixture(autouse=True)
+def memory_backend(monkeypatch):
+    """Stores cached results in a MemoryBackend, without a memory tier in
+    front of it."""
+    monkeypatch.setattr(SimpleDiskCache, 'configured_backend',
+                        lambda setting, name, lifetime=None:
+                        open_backend('memory', name, lifetime))
+    monkeypatch.setattr(SimpleDiskCache, 'memory_cache_for',
+                        lambda filename: None)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Lets tests move the caches' clock forward, by setting `offset`
+    seconds."""
+    clock = {'offset': 0}
+    monkeypatch.setattr(SimpleDiskCache, 'time',
+                        lambda: time() + clock['offset'])
+    return clock
+
+
+@pytest.fixture
+def refresh_pool(monkeypatch):
+    """Runs background refreshes on a pool of a single thread, which tests
+    can shut down to wait for them."""
+    pool = ThreadPoolExecutor(1)
+    monkeypatch.setattr(SimpleDiskCache, '_refresh_pool', pool)
+    monkeypatch.setattr(SimpleDiskCache, '_refresh_pool_pid', os.getpid())
+    monkeypatch.setattr(SimpleDiskCache, '_refreshing', set())
+    yield pool
+    pool.shutdown()
+
+
+def test_lookup_many():
+    """Tests that bulk lookups find stored results in order, without
+    calling the function."""
+    calls = []
+
+    @expiring_cache('test_lookup_many', 60)
+    def double(x):
+        calls.append(x)
+        return x * 2
+
+    double.store(4, 2)
+
+    assert double.lookup_many([(2,), (3,)]) == [(True, 4), (False, None)]
+    assert double.lookup_stale_many([(2L,)]) == [(True, 4, FRESH)]
+    assert calls == []
+
+
+def test_stale_results_refreshed_in_background(clock, refresh_pool):
+    """Tests that results within the grace period are returned straight
+    away, while being refreshed once in the background."""
+    answers = ['old']
+    calls = []
+    refreshing = threading.Event()
+
+    @expiring_cache('test_stale_results', 60, grace=60)
+    def answer(x):
+        calls.append(in_background_refresh())
+        if in_background_refresh():
+            refreshing.wait()
+
+        return answers[0]
+
+    assert answer(1) == 'old'
+
+    answers[0] = 'new'
+    clock['offset'] = 90
+    assert answer(1) == 'old'
+    assert answer(1) == 'old'
+
+    refreshing.set()
+    refresh_pool.shutdown()
+    assert calls == [False, True]
+    assert answer(1) == 'new'
+    assert answer.lookup_stale(1) == (True, 'new', FRESH)
+
+
+def test_expired_results_retrieved_again(clock, refresh_pool):
+    """Tests that results past the grace period are retrieved again before
+    being returned."""
+    answers = ['old']
+    calls = []
+
+    @expiring_cache('test_expired_results', 60, grace=60)
+    def answer(x):
+        calls.append(in_background_refresh())
+        return answers[0]
+
+    assert answer(1) == 'old'
+
+    answers[0] = 'new'
+    clock['offset'] = 150
+    assert answer(1) == 'new'
+    assert calls == [False, False]
+
+
+@pytest.fixture
+def legacy_keys_since(monkeypatch):
+    """Forgets when caches started migrating legacy keys in this process,
+    as if it had just started."""
+    since = {}
+    monkeypatch.setattr(SimpleDiskCache, '_legacy_keys_since', since)
+    return since
+
+
+def test_legacy_entries_migrated_for_lifetime(clock, legacy_keys_since):
+    """Tests that entries saved under legacy keys are moved to their new
+    keys until the cache's lifetime has passed since it started migrating
+    them, across restarts."""
+    calls = []
+
+    @expiring_cache('test_legacy_expiring', 60, grace=60, legacy_keys=True)
+    def double(x):
+        calls.append(x)
+        return x * 2
+
+    backend = open_backend('memory', 'test_legacy_expiring', 120)
+    backend.set(legacy_cache_key((1,), {}), 'old', time(), 120)
+    backend.set(legacy_cache_key((2,), {}), 'old', time() + 110, 120)
+
+    assert double(1) == 'old'
+
+    # Restarting doesn't restart the migration.
+    legacy_keys_since.clear()
+    clock['offset'] = 100
+    assert double.lookup_stale_many([(1,), (2,)])[1] == (True, 'old', FRESH)
+
+    clock['offset'] = 130
+    assert double(3) == 6
+    assert backend.get(legacy_cache_key((3,), {})) is None
+    assert calls == [3]
+
+
+def test_legacy_entries_migrated_for_period(monkeypatch, clock,
+                                            legacy_keys_since):
+    """Tests that caches whose entries never expire move entries saved
+    under legacy keys for config.legacy_cache_keys_period seconds."""
+    class Settings(object):
+        legacy_cache_keys_period = 60
+
+    monkeypatch.setattr(SimpleDiskCache, 'config', Settings)
+    calls = []
+
+    @cache('test_legacy_file', legacy_keys=True)
+    def double(x):
+        calls.append(x)
+        return x * 2
+
+    backend = open_backend('memory', 'test_legacy_file')
+    for x in (1, 2, 3):
+        backend.set(legacy_cache_key((x,), {}), 'old', time())
+
+    assert double(1) == 'old'
+    assert double.lookup_many([(2,)]) == [(True, 'old')]
+
+    clock['offset'] = 90
+    assert double(3) == 6
+    assert calls == [3]
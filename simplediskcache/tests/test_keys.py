@@ -0,0 +1,42 @@
+from ..keys import cache_key, legacy_cache_key, normalize_text, normalized
+
+
+def search(query, access_token='token'):
+    pass
+
+
+def profile(profile_id):
+    pass
+
+
+def test_keys_ignore_how_arguments_are_passed():
+    key = cache_key(search, ('apple',), {})
+    assert cache_key(search, (), {'query': 'apple'}) == key
+    assert cache_key(search, ('apple', 'token'), {}) == key
+    assert cache_key(search, ('pear',), {}) != key
+
+
+def test_keys_leave_out_credentials():
+    key = cache_key(search, ('apple',), {'access_token': 'secret'})
+    assert key == cache_key(search, ('apple',), {'access_token': 'other'})
+    assert 'secret' not in key
+    assert len(key) == 40
+
+
+def test_keys_match_equal_strings_and_numbers():
+    key = cache_key(search, ('apple',), {})
+    assert cache_key(search, (u'apple',), {}) == key
+    assert cache_key(profile, (123,), {}) == cache_key(profile, (123L,), {})
+
+
+def test_normalized_keys():
+    key_func = normalized('query')
+    key = cache_key(search, ('Apple  Inc',), {}, key_func)
+    assert cache_key(search, (u' apple inc ',), {}, key_func) == key
+    assert cache_key(search, ('Apple  Inc',), {}) != key
+
+    assert normalize_text(u'\xc4pple') == normalize_text('\xc3\x84pple')
+
+
+def test_legacy_keys():
+    assert legacy_cache_key(('apple',), {}) == "('apple',){}"
@@ -0,0 +1,51 @@
+import time
+
+from ..MemoryCache import MemoryCache
+
+
+def test_lookup_after_set():
+    """Tests that a stored value is found, and counted as a hit."""
+    cache = MemoryCache(max_size=2)
+    cache.set('a', 1)
+
+    assert cache.lookup('a') == (True, 1)
+    assert cache.lookup('b') == (False, None)
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 1
+
+
+def test_lru_evicts_least_recently_used():
+    """Tests that reading an entry protects it from eviction under the
+    LRU policy."""
+    cache = MemoryCache(max_size=2, policy='lru')
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+
+    assert cache.get('a') == 1
+    assert cache.get('b') is None
+    assert cache.stats()['evictions'] == 1
+
+
+def test_fifo_evicts_oldest_write():
+    """Tests that reading an entry doesn't protect it from eviction under
+    the FIFO policy."""
+    cache = MemoryCache(max_size=2, policy='fifo')
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+
+    assert cache.get('a') is None
+    assert cache.get('b') == 2
+
+
+def test_entries_expire():
+    """Tests that entries are not returned after their TTL."""
+    cache = MemoryCache(max_size=2, ttl=0.01)
+    cache.set('a', 1)
+    time.sleep(0.02)
+
+    assert cache.lookup('a') == (False, None)
+    assert len(cache) == 0
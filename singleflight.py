@@ -0,0 +1,58 @@
+from concurrent.futures import Future
+import threading
+
+
+class SingleFlight(object):
+    """Coalesces concurrent calls that share a key, so that only the first
+    caller does the work, and the others wait for and share its result."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = {}
+
+    def do(self, key, func, *args, **kwargs):
+        """Calls func(*args, **kwargs) and returns its result, unless a call
+        with the same key is already in progress, in which case its result is
+        returned instead. Exceptions are raised to every waiting caller."""
+        future, is_leader = self.lead(key)
+        if not is_leader:
+            return future.result()
+
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            self.finish(key, exception=e)
+            raise
+
+        self.finish(key, result)
+        return result
+
+    def lead(self, key):
+        """Returns a (future, is_leader) pair, for callers that can't pass
+        their work to `do`. If a call with the same key is in progress, the
+        future is that call's. Otherwise the caller is the leader, and must
+        pass its outcome to `finish`, which completes the future for the
+        callers waiting on it."""
+        with self.lock:
+            future = self.in_flight.get(key)
+            if future is not None:
+                return future, False
+
+            future = Future()
+            self.in_flight[key] = future
+            return future, True
+
+    def finish(self, key, result=None, exception=None):
+        """Completes the call in progress for key, started with `lead`,
+        with its result or the exception it raised."""
+        with self.lock:
+            future = self.in_flight.pop(key)
+
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+    def in_progress(self):
+        """Returns the number of keys with a call in progress."""
+        with self.lock:
+            return len(self.in_flight)
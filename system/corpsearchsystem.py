@@ -1,3 +1,10 @@
+from time import time
+import os
+import threading
+
+import metrics
+
+
 class CorpSearchSystem(object):
     """Defines a system consisting of a set of features that convert
     profiles into vectors. This can be used to easily specify different
@@ -10,6 +17,11 @@ class CorpSearchSystem(object):
         for feature in self.features:
             self.labels += feature.feature_labels()
 
+        # Preprocessed data is kept in memory per network, along with the
+        # state of the files it was loaded from.
+        self.loaded_data = {}
+        self.loading_lock = threading.Lock()
+
     def feature_vector_labels(self):
         """Returns the list of labels for each field in the vector."""
         return self.labels
@@ -20,7 +32,10 @@ class CorpSearchSystem(object):
         vector = []
 
         for feature in self.features:
-            vector += feature.score(query=query, profile=profile, data=data)
+            with metrics.stage_latency.time(stage='feature:' +
+                                            feature.__name__):
+                vector += feature.score(query=query, profile=profile,
+                                        data=data)
 
         return vector
 
@@ -30,9 +45,45 @@ class CorpSearchSystem(object):
         for feature in self.features:
             feature.preprocess(profiles, network_name)
 
+        self.loaded_data.pop(network_name, None)
+
     def retrieve_preprocessed_data(self, network_name):
         """Given the name of a social network, retrieves the preprocessed
-        data for that network from all features."""
+        data for that network from all features.
+
+        The data is loaded once and kept in memory, and is only loaded again
+        when the files it came from change. The returned dictionary is
+        shared, and must not be modified."""
+        files = self.preprocessed_data_files(network_name)
+        signature = file_signature(files)
+
+        loaded = self.loaded_data.get(network_name)
+        if loaded is not None and loaded['signature'] == signature:
+            return loaded['data']
+
+        with self.loading_lock:
+            loaded = self.loaded_data.get(network_name)
+            if loaded is not None and loaded['signature'] == signature:
+                return loaded['data']
+
+            start = time()
+            data = self.load_preprocessed_data(network_name)
+            end = time()
+
+            self.loaded_data[network_name] = {
+                'signature': signature,
+                'data': data,
+                'loaded_at': end,
+                'load_seconds': end - start,
+                'bytes': sum(x[2] for x in signature if x[2] is not None),
+                'loads': (loaded['loads'] + 1) if loaded is not None else 1
+            }
+
+            return data
+
+    def load_preprocessed_data(self, network_name):
+        """Given the name of a social network, loads the preprocessed data
+        for that network from all features, bypassing the in-memory copy."""
         data = {}
         for feature in self.features:
             feature_data = feature.retrieve_preprocessed_data(network_name)
@@ -40,3 +91,49 @@ class CorpSearchSystem(object):
                 data.update(feature_data)
 
         return data
+
+    def preprocessed_data_files(self, network_name):
+        """Given the name of a social network, returns the paths of the files
+        that the features' preprocessed data is stored in."""
+        files = []
+        for feature in self.features:
+            files += feature.preprocessed_data_files(network_name)
+
+        return files
+
+    def preprocessed_data_stats(self):
+        """Returns a dictionary keyed by network name, describing the
+        preprocessed data held in memory for that network:
+
+            `loaded_at`: the time the data was last loaded.
+
+            `load_seconds`: how long loading the data took.
+
+            `bytes`: the total size of the files the data was loaded from.
+
+            `loads`: how many times the data has been loaded."""
+        stats = {}
+        for network_name, loaded in self.loaded_data.items():
+            stats[network_name] = {
+                'loaded_at': loaded['loaded_at'],
+                'load_seconds': loaded['load_seconds'],
+                'bytes': loaded['bytes'],
+                'loads': loaded['loads']
+            }
+
+        return stats
+
+
+def file_signature(paths):
+    """Returns a tuple of (path, modification time, size) for each of the
+    given paths, which changes whenever one of the files does. Missing files
+    have a modification time and size of None."""
+    signature = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            signature.append((path, stat.st_mtime, stat.st_size))
+        except OSError:
+            signature.append((path, None, None))
+
+    return tuple(signature)
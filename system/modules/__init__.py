@@ -23,3 +23,9 @@ class BaseFeature(object):
     def retrieve_preprocessed_data(network_name):
         """Retrieve the preprocessed data from wherever it's stored."""
         return None
+
+    @staticmethod
+    def preprocessed_data_files(network_name):
+        """Should return the paths of the files the preprocessed data is
+        stored in, so that changes to them can be detected."""
+        return []
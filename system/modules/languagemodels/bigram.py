@@ -68,6 +68,11 @@ class DescriptionLanguageModel(BaseFeature):
 
         return data
 
+    @staticmethod
+    def preprocessed_data_files(network_name):
+        labels = ['correct', 'affiliate', 'incorrect']
+        return [network_name + 'BigramLM-' + label for label in labels]
+
 
 class PostContentLanguageModel(BaseFeature):
     """In the preprocessing stage, this feature generates three bigram language
@@ -139,3 +144,8 @@ class PostContentLanguageModel(BaseFeature):
                 data[label + '_post_bigram_LM'] = model
 
         return data
+
+    @staticmethod
+    def preprocessed_data_files(network_name):
+        labels = ['correct', 'affiliate', 'incorrect']
+        return [network_name + 'PostBigramLM-' + label for label in labels]
@@ -10,6 +10,10 @@ class ProfileBase(object):
     social networks."""
     __metaclass__ = abc.ABCMeta
 
+    # Whether the profile is missing data (such as posts) that couldn't be
+    # retrieved in time.
+    partial = False
+
     @abc.abstractproperty
     def display_name(self):
         return 'Display Name'
@@ -68,7 +72,7 @@ class TwitterProfile(ProfileBase):
 
         url_field = [self.backing_data['url']] if 'url' in self.backing_data else []
         shortened_urls = [x for x in url_field if x is not None]
-        urls = [UrlResolver.resolve_shortened_url(x) for x in shortened_urls]
+        urls = UrlResolver.resolve_shortened_urls(shortened_urls)
         return urls
 
     @property
@@ -6,7 +6,6 @@ from social_profile import FacebookProfile, TwitterProfile
 import itertools
 
 import config
-import mongo
 
 training_set = namedtuple('TrainingSet', ['data', 'labels'])
 
@@ -119,6 +118,8 @@ def train_facebook(classifier):
 def get_twitter_entries():
     """Connects to MongoDB and returns all Twitter profiles with their
     labels."""
+    # Imported here, as importing mongo connects to the server.
+    import mongo
     client = mongo.client
     labels = client.labels.twitter
     profiles = client.searchresults.twitterProfiles
@@ -149,6 +150,8 @@ def get_twitter_entries():
 def get_facebook_entries():
     """Connects to MongoDB and returns all Facebook profiles with their
     labels."""
+    # Imported here, as importing mongo connects to the server.
+    import mongo
     client = mongo.client
     labels = client.labels.facebook
     profiles = client.searchresults.facebookProfiles
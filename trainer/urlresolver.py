@@ -3,22 +3,36 @@ from simplediskcache.SimpleDiskCache import cache
 import requests
 import tldextract
 
+import httpclient
+import metrics
+
 
 class UrlResolver(object):
     """Resolves shortened URLs and finds their final destination."""
 
     @staticmethod
-    @cache('urls')
+    @cache('urls', legacy_keys=True)
     def resolve_shortened_url(url):
         """Returns the final destination of a shortened URL. This is done by
         making a request to it."""
         try:
-            request = requests.get(url, timeout=5)
+            request = httpclient.get(url, timeout=5)
             resolved_url = request.url
             return resolved_url
         except (requests.ConnectionError, requests.exceptions.Timeout) as e:
+            metrics.upstream_errors.inc(service='url_resolver')
             return e.request.url
 
+    @staticmethod
+    def resolve_shortened_urls(urls):
+        """Returns the final destinations of a list of shortened URLs,
+        looking up those already resolved all at once."""
+        resolver = UrlResolver.resolve_shortened_url
+        cached = resolver.lookup_many([(x,) for x in urls])
+
+        return [value if found else resolver(url)
+                for url, (found, value) in zip(urls, cached)]
+
     @staticmethod
     def get_domain_for_url(url):
         """Returns the domain of a given URL."""